@@ -19,29 +19,26 @@ VERSION:        3.0.1
 # -------------------------------------------------------------------------
 # python
 import json
-import time
 import base64
-import io
-import zipfile
 import regex as re
 from datetime import datetime
-import os
-from pathlib import Path
 
 # local
+import compute
 import utils
 
 # 3rd party:
 import streamlit as st
 import pandas as pd
-from streamlit_folium import folium_static
-import folium
+import streamlit.components.v1 as components
 import toml
-import requests
 
 
 # Page setup
 # -------------------------------------------------------------------------
+# Caches the compute functions (e.g. utils.get_data) with Streamlit's cache, rather than the default in-process cache
+compute.set_cache_backend(st.cache_data)
+
 #Config file defined
 config = toml.load('config.toml')
 
@@ -57,6 +54,11 @@ st.set_page_config(
         "About": "This tool is designed to support allocation at places by allowing places to be defined by aggregating GP Practices within an ICB. Please refer to the User Guide for instructions. For more information on the latest allocations, including contact details, please refer to: [https://www.england.nhs.uk/allocations/](https://www.england.nhs.uk/allocations/)",
     },
 )
+# Times each stage of this rerun if "Show Performance" is ticked under Advanced Options (its value is kept from the previous rerun)
+# Otherwise profiling is switched off, and the utils.stage calls below and the timed compute functions do nothing
+profiler = utils.start_profiler(st.session_state.get("show_performance", False))
+utils.stage("Page setup")
+
 padding = 1
 st.markdown(
     f""" <style>
@@ -92,66 +94,81 @@ def render_svg(svg):
     html = r'<img src="data:image/svg+xml;base64,%s"/>' % b64
     st.write(html, unsafe_allow_html=True)
 
+# Shares one dataset registry between all sessions, so each year is loaded once per process
+@st.cache_resource
+def get_registry(folder, max_loaded, population_dtype):
+    return utils.DatasetRegistry(folder, max_loaded, population_dtype)
+
+# Shares one bounded cache of place results between all sessions, so places that many visitors have (like the default place) are only calculated once
+@st.cache_resource
+def get_result_cache(max_entries):
+    return utils.ResultCache(max_entries)
+
+# Shares one cache of the GitHub "last updated" dates between all sessions
+@st.cache_resource
+def get_last_updated_cache(ttl):
+    return utils.LastUpdatedCache(ttl)
+
+# Builds the ZIP download (Excel file of results for every year, documentation, and session data)
+# Cached on export_key, a hash of the session data, data versions and headers (arguments starting with "_" aren't hashed by Streamlit)
+@utils.timed
+@st.cache_data(max_entries=20, show_spinner="Preparing download...")
+def build_download_zip(export_key, _session_state_dict, _csv_headers):
+    # Loads and aggregates one year at a time so only a bounded number of years are held in memory
+    data_by_year = (
+        (year, utils.get_data_for_all_years({year: registry.get(year)}, _session_state_dict, aggregations, index_numerator, index_names, icb_tables={year: registry.derive(year, "icb_table", utils.build_icb_table)})[year])
+        for year in registry.years
+    )
+    # Open the text documentation file
+    with open("docs/ICB allocation tool documentation.txt", "rb") as fh:
+        readme_text = fh.read()
+    return utils.write_zip({
+        "ICB allocation calculations.xlsx": utils.write_excel(data_by_year, *_csv_headers),
+        "ICB allocation tool documentation.txt": readme_text,
+        "ICB allocation tool configuration file.json": utils.write_session(_session_state_dict),
+    })
+
 # Download functionality
 @st.cache_data
 def convert_df(df):
     return df.to_csv(index=False).encode("utf-8")
 
 # Create metric_calcs function
-# Fetches the specified metric from the given dataframe, and rounds it using "excel_round", giving the place_metric output used in the tool
+# Fetches the specified metric from the given dataframe, and rounds it using "excel_round_array", giving the place_metric output used in the tool
 # When called below:
 ## "group_need_indices" are the df created by the "get_data_for_all_years" function
 ## "metric_index" the name of the column to be retrieved from the df
 def metric_calcs(group_need_indices, metric_index):
-    # Convert the value to float and round it using excel_round to 2 decimal places
-    place_metric = utils.excel_round(group_need_indices[metric_index][0].astype(float), 0.01)
+    # Convert the value to float and round it using excel_round_array to 2 decimal places
+    place_metric = utils.excel_round_array(group_need_indices[metric_index].iloc[:1], 0.01)[0]
     return place_metric
 
-# Create aggregations dictionary, used in get_data_for_all_years function; tells function how to aggregate each column
-aggregations = {
-    "GP pop": "sum",
-    "Weighted G&A pop": "sum",
-    "Weighted Community pop": "sum",
-    "Weighted Mental Health pop": "sum",
-    "Weighted Maternity pop": "sum",
-    "Weighted Prescribing pop": "sum",
-    "Overall Weighted pop": "sum",
-    "Weighted Primary Care": "sum",
-    "Weighted Primary Medical Care Need": "sum",
-    "Weighted Health Inequalities pop": "sum",
-}
-
-#Create index_numerator list, used in get_data_for_all_years function; see utils file for full info
-index_numerator = [
-    "Weighted G&A pop",
-    "Weighted Community pop",
-    "Weighted Mental Health pop",
-    "Weighted Maternity pop",
-    "Weighted Prescribing pop",
-    "Overall Weighted pop",
-    "Weighted Primary Care",
-    "Weighted Primary Medical Care Need",
-    "Weighted Health Inequalities pop",
-]
-
-#Create index_names list, used in get_data_for_all_years function; see utils file for full info
-index_names = [
-    "G&A Index",
-    "Community Index",
-    "Mental Health Index",
-    "Maternity Index",
-    "Prescribing Index",
-    "Overall Core Index",
-    "Primary Medical Care Index",
-    "Primary Medical Care Need Index",
-    "Health Inequalities Index",  
-]
-
-# Uses the get_latest_commit_date function from utils to fetch the most recent commit date based on details from the config file and stores it in last_commit_date for use on page
-last_commit_date = utils.get_latest_commit_date(config['owner'], config['repo'], config['branch'])
+# Aggregations, index numerators and index names used in get_data_for_all_years function; defined in utils so they are shared with batch.py
+aggregations = utils.AGGREGATIONS
+index_numerator = utils.INDEX_NUMERATOR
+index_names = utils.INDEX_NAMES
+
+utils.stage("Last updated dates")
+# Shares one cache of "last updated" dates between all sessions; GitHub is only called from a background thread at most once per ttl (see utils.LastUpdatedCache)
+last_updated = get_last_updated_cache(config['last_updated_ttl'])
+
+# Fetches the most recent commit date based on details from the config file and stores it in last_commit_date for use on page
+# Until GitHub has responded (or if it can't be reached) the date of the last local commit is used instead
+# Both are looked up in the background, so for the first moments after the app starts the date shows as not yet known
+last_commit_date = last_updated.get(
+    "commit",
+    lambda: utils.fetch_latest_update(config['owner'], config['repo'], config['branch']),
+    lambda: utils.get_local_update_date("."),
+    default="not yet known",
+)
 
-# Uses the get_latest_folder_update to find the last update to the data folder, based on details from the config file, and stores it in last_folder_update for use on page
-last_folder_update = utils.get_latest_folder_update(config['owner'], config['repo'], config['folder_path'], config['branch'])
+# Finds the last update to the data folder, based on details from the config file, and stores it in last_folder_update for use on page
+last_folder_update = last_updated.get(
+    "data",
+    lambda: utils.fetch_latest_update(config['owner'], config['repo'], config['branch'], folder_path=config['folder_path']),
+    lambda: utils.get_local_update_date(config['folder_path']),
+    default="not yet known",
+)
 
 
 # Header section
@@ -178,12 +195,12 @@ st.write(f"""Data last updated: {last_folder_update}""")
 # Call the function to set sidebar width
 utils.set_sidebar_width(min_width=500, max_width=500)
 
-# Creates a list containing the filenames of files in the data folder
-datasets = os.listdir('data/')
+# Creates the registry of yearly datasets in the data folder; years are only loaded when they are viewed or exported (see utils.DatasetRegistry)
+registry = get_registry('data/', config['max_loaded_years'], config['population_dtype'])
+result_cache = get_result_cache(config['result_cache_size'])
 
-# Creates dropdown box for time-period selection and stores relevant filename with ".csv" removed in "selected_year"
-selected_dataset = st.sidebar.selectbox("Time Period:", options = datasets, help="Select a time period", format_func=lambda x : x.replace('.csv','').replace('_','/'))
-selected_year = selected_dataset.replace('.csv', '')
+# Creates dropdown box for time-period selection and stores the selected year (the filename with ".csv" removed) in "selected_year"
+selected_year = st.sidebar.selectbox("Time Period:", options = registry.years, help="Select a time period", format_func=lambda x : x.replace('_','/'))
 
 # Creates a horizontal separator, dividing the time-period selector from the Create New Place section of the sidebar
 st.sidebar.write("-" * 34)
@@ -191,21 +208,19 @@ st.sidebar.write("-" * 34)
 
 # Import Data
 # -------------------------------------------------------------------------
-# Creates empty dataset_dict dictionary used in next step of code
-dataset_dict = {}
-
-# Iterates through each dataset(year) in the data folder importing the data using the get_data function from utils.
-# Imported data is stored in the library created above, as a dataframe for each year
-for dataset in datasets:
-    year = dataset.replace('.csv', '')
-    dataset_dict[year] = utils.get_data('data/' + dataset)
+utils.stage("Data loading")
+# Imports the data for the selected time-period only, as a dataframe; other years are loaded when the data is downloaded
+year_data = registry.get(selected_year)
 
-# Uses get_sidebar function to store a list of ICBs from the dataframe for the selected time-period; see utils doc for more info on get_sidebar
-icb = utils.get_sidebar(dataset_dict[selected_year])
+# Looks the sidebar lists up in the selection index for the selected time-period (ICB -> LA District -> practices), built once per year
+# so the sidebar never filters the whole dataset; see utils.build_selection_index
+selection_index = registry.derive(selected_year, "selection_index", utils.build_selection_index)
+icb = selection_index["icbs"]
 
 
 # SIDEBAR Main
 # -------------------------------------------------------------------------
+utils.stage("Sidebar")
 # Sidebar subheader
 st.sidebar.subheader("Create New Place")
 
@@ -216,10 +231,8 @@ with st.sidebar.expander("Select an ICB", expanded=True):
     # Creates drop-down box with list of ICBs based on icb value created above
     icb_choice = st.selectbox("Select an ICB from the drop-down", icb, help="Select an ICB", label_visibility="hidden")
 
-    # Generate the list of LADs by filtering the dataset for the selected time period based on the ICB selected above
-    lad = dataset_dict[selected_year]["LA District name"].loc[
-        dataset_dict[selected_year]["ICB name"] == icb_choice
-    ].unique().tolist()
+    # Looks up the list of LADs in the ICB selected above
+    lad = list(selection_index["lads"].get(icb_choice, {}))
 
     # Create a DataFrame from the list of LADs
     lad_list_to_select = pd.DataFrame(lad, columns=['Local Authority District'])
@@ -240,18 +253,8 @@ with st.sidebar.expander("Select an ICB", expanded=True):
         # Outputs from above LAD tick-list saved to selected_lads list
         selected_lads = lad_choice[lad_choice['tick']]["Local Authority District"].tolist()
 
-    # Filter practices based on selected ICB and LADs
-    # Checks whether the selected_lads variable contains data to determine whether to filter on LAD and ICB, or just ICB
-    # Outputs the practice_display field to filtered_practices variable as a list
-    if not selected_lads:
-        filtered_practices = dataset_dict[selected_year]["practice_display"].loc[
-            dataset_dict[selected_year]["ICB name"] == icb_choice
-        ].unique().tolist()
-    else:
-        filtered_practices = dataset_dict[selected_year]["practice_display"].loc[
-            (dataset_dict[selected_year]["LA District name"].isin(selected_lads)) &
-            (dataset_dict[selected_year]["ICB name"] == icb_choice)
-        ].unique().tolist()
+    # Looks up the practices in the selected ICB, narrowed to the selected LADs if there are any, as a sorted list
+    filtered_practices = utils.select_practices(selection_index, icb_choice, selected_lads)
 
     # Creates a dataframe from the filtered_practices list
     practice_list_to_select = pd.DataFrame(filtered_practices, columns=['GP Practice'])
@@ -369,6 +372,7 @@ if st.sidebar.button("Save Place", help="Save place to session data"):
 # Horizontal separator for the sidebar
 st.sidebar.write("-" * 34)
 
+utils.stage("Session data")
 # Creates a dictionary (session_state_dict) where each place from the places list is added with an empty list
 session_state_dict = dict.fromkeys(st.session_state.places, [])
 
@@ -378,8 +382,14 @@ for key, value in session_state_dict.items():
 # Adds a new key to the session_state_dict named places and adds the list of places from session_state as the associated value
 session_state_dict["places"] = st.session_state.places
 
-# Dumps the contents of the session_state_dict into a json string named session_state_dump used to download session data
-session_state_dump = json.dumps(session_state_dict, indent=4, sort_keys=False)
+# Writes the places in session_state_dict as a session file (JSON listing the practice codes of each place), used to download session data
+session_state_dump = utils.write_session(session_state_dict).decode("utf-8")
+
+# Progress bar for calculating the places in an uploaded file; only created when a file is submitted
+upload_progress = None
+cache_status = None
+# Expander for the timings of the rerun; only created when "Show Performance" is ticked
+performance_panel = None
 
 # Create the Advanced Options tick-box in the sidebar which toggles the download and upload features on and off
 advanced_options = st.sidebar.checkbox("Advanced Options")
@@ -388,14 +398,22 @@ if advanced_options:
     st.sidebar.download_button(
         label="Download session data as JSON",
         data=session_state_dump,
-        file_name="session.json",
-        mime="text/json",
+        file_name=utils.SESSION_ENCODINGS["json"][0],
+        mime=utils.SESSION_ENCODINGS["json"][1],
     )
+    # Sessions with many places are much smaller compressed; the file is only written when there are enough places for it to matter
+    if len(st.session_state.places) > 100:
+        st.sidebar.download_button(
+            label="Download compressed session data",
+            data=utils.write_session(session_state_dict, "gzip"),
+            file_name=utils.SESSION_ENCODINGS["gzip"][0],
+            mime=utils.SESSION_ENCODINGS["gzip"][1],
+        )
     # Creates a form in the sidebar with key "my-form" (a container that groups multiple input widgets to be submitted together)
     form = st.sidebar.form(key="my-form")
-    # Adds a file-uploader to the form restricted to json files, stored under group_file
+    # Adds a file-uploader to the form restricted to session files (JSON, compressed JSON or MessagePack), stored under group_file
     group_file = form.file_uploader(
-        "Upload previous session data as JSON", type=["json"]
+        "Upload previous session data", type=["json", "gz", "msgpack"]
     )
     # Adds a submit button to the form
     submit = form.form_submit_button("Submit")
@@ -403,26 +421,52 @@ if advanced_options:
     if submit:
         # Checks whether file was uploaded
         if group_file is not None:
-            # Stores loaded file under variable "d"
-            d = json.load(group_file)
-            # Overwrites the list of places in session_state with the list from the uploaded file
-            st.session_state.places = d["places"]
-            # Stores the individual place data in the session_state from the uploaded file
-            for place in d["places"]:
-                st.session_state[place] = d[place]
-            # Displays a progress bar increasing 1% per 0.01 seconds
-            my_bar = st.sidebar.progress(0)
-            for percent_complete in range(100):
-                time.sleep(0.01)
-                my_bar.progress(percent_complete + 1)
-            my_bar.empty()
+            # Reads the uploaded file and matches all of its places to the selected year on their practice codes in one go, dropping duplicate places
+            try:
+                uploaded_session, upload_report = utils.import_session(group_file.getvalue(), year_data)
+            except ValueError as e:
+                uploaded_session, upload_report = None, None
+                st.sidebar.error(f"Could not read the uploaded file: {e}")
+            if uploaded_session is not None and not uploaded_session["places"]:
+                st.sidebar.error("The uploaded file doesn't contain any valid places")
+            elif uploaded_session is not None:
+                # Overwrites the list of places in session_state with the list from the uploaded file
+                st.session_state.places = uploaded_session["places"]
+                # Stores the individual place data in the session_state from the uploaded file
+                for place in uploaded_session["places"]:
+                    st.session_state[place] = uploaded_session[place]
+                st.sidebar.success(f"Imported {len(uploaded_session['places'])} of {len(upload_report)} places")
+                # Lists the places that were skipped or have practices that aren't in the selected year
+                upload_problems = upload_report.loc[
+                    (upload_report["Status"] != "Imported")
+                    | (upload_report["Missing practices"] > 0)
+                    | (upload_report["Practices in another ICB"] > 0)
+                ]
+                if not upload_problems.empty:
+                    with st.sidebar.expander(f"{len(upload_problems)} places need checking", expanded=True):
+                        st.caption(f"Missing practices aren't in the data for {selected_year.replace('_','/')}")
+                        st.dataframe(upload_problems, hide_index=True)
+                # Displays a progress bar, which is advanced as the uploaded places are calculated below
+                upload_progress = st.sidebar.progress(0, text="Calculating places...")
+    # Placeholder for the use of the shared results cache, filled in once the places have been calculated below
+    cache_status = st.sidebar.empty()
+    # Creates a tickbox to time each stage of the rerun, with the timings shown in an expander once the page has been drawn
+    if st.sidebar.checkbox("Show Performance", key="show_performance", help="Time each stage of the page, from the next rerun"):
+        performance_panel = st.sidebar.expander("Performance", expanded=True)
 
 # Creates a tickbox to toggle the display of session data (used later in the main body)
 see_session_data = st.sidebar.checkbox("Show Session Data")
+# Creates a tickbox to toggle the figures for standard geographies (used later in the main body)
+show_standard_geographies = st.sidebar.checkbox("Show Standard Geographies", help="Show the indices of every Region, ICB, LA District, PCN and practice, relative to England")
+# Creates a tickbox to toggle the comparison of all time periods (used later in the main body)
+compare_time_periods = st.sidebar.checkbox("Compare Time Periods", help="Show the places in every time period, with the change in each index")
+# Creates a tickbox to toggle the comparison of place designs (used later in the main body)
+compare_place_designs = st.sidebar.checkbox("Compare Place Designs", help="Compare alternative ways of splitting an ICB into places")
 
 
 # BODY
 # -------------------------------------------------------------------------
+utils.stage("Place selection")
 # Sets select_index to be the length of the list of places -1, which is the index of the last item in the list (due to Python indexing)
 select_index = len(st.session_state.places) - 1  # find n-1 index
 # Creates an empty placeholder
@@ -443,8 +487,6 @@ if "after" not in st.session_state:
 # Creates a "Delete Current Selection" button; sets delete_place to true when clicked
 label = "Delete Current Selection"
 delete_place = st.button(label, help=label)
-# Creates an empty placeholder for the delete progress bar
-my_bar_delete = st.empty()
 # Code below runs if button is clicked
 if delete_place:
     # Confirms there is only one place in the list (i.e. the default place needs to be reinstated)
@@ -477,11 +519,6 @@ if delete_place:
         st.warning(
             "All places deleted. 'Default Place' reset to default. Please create a new place."
         )
-        my_bar_delete.progress(0)
-        for percent_complete in range(100):
-            time.sleep(0.01)
-            my_bar_delete.progress(percent_complete + 1)
-        my_bar_delete.empty()
     # If there is more than once place in the list then the below executes
     else:
         # Deletes from the session_state the currently selected place (stored in session_state.after)
@@ -492,12 +529,6 @@ if delete_place:
                 st.session_state.places.index(st.session_state.after)
             ]
         ]
-        # Displays a progress bar, increasing 1% every 0.01 seconds
-        my_bar_delete.progress(0)
-        for percent_complete in range(100):
-            time.sleep(0.01)
-            my_bar_delete.progress(percent_complete + 1)
-        my_bar_delete.empty()
 
 # Recreates the drop-down menu selectbox to reflect the updated list
 # Sets select_index to be the length of the list of places -1, which is the index of the last item in the list (due to Python indexing)
@@ -515,48 +546,40 @@ group_gp_list = st.session_state[st.session_state.after]["gps"]
 
 # MAP
 # -------------------------------------------------------------------------
-# Initialises the map
-map = folium.Map(location=[52, 0], zoom_start=10, tiles="openstreetmap")
-# Initialises the list of latitudes
-lat = []
-# Initialises the list of longitudes
-long = []
-
-# Populates the map with the coordinates of the practices in the group_gp_list created above
-# Cycles through each gp practice in the list, performing the below
-for gp in group_gp_list:
-    # Uses the escape function to avoid special characters in gp names breaking code
-    escaped_gp = re.escape(gp)
-    # If the practice name isn't found in the list of practice names in the dataset an error is printed and the loop moves to the next practice
-    if ~dataset_dict[selected_year]["practice_display"].str.contains(escaped_gp).any():
-        st.write(f"{gp} is not available in this time period")
-        continue
-    # Retrieves the practice's latitude and longitude from the values in the dataset
-    latitude = dataset_dict[selected_year]["Latitude"].loc[dataset_dict[selected_year]["practice_display"] == gp].item()
-    longitude = dataset_dict[selected_year]["Longitude"].loc[dataset_dict[selected_year]["practice_display"] == gp].item()
-    # Append the retrieved longitude and latitude to the lists
-    lat.append(latitude)
-    long.append(longitude)
-    # Adds a marker to the map with a popup label matching the gp entry in the group_gp_list
-    folium.Marker(
-        [latitude, longitude],
-        popup=str(gp),
-        icon=folium.Icon(color="darkblue", icon="fa-user-md", prefix="fa"),
-    ).add_to(map)
-
-# If the latitude list is empty, print an error message to say there are no practices from the place available
-if not lat:
+utils.stage("Map")
+# Looks up the practices in the group_gp_list created above in the practice index for the selected year (built once per year, see utils.build_practice_index)
+# The practices are looked up on their codes, so practices renamed since the place was created are still found, and are shown with the year's names
+practice_index = registry.derive(selected_year, "practice_index", utils.build_practice_index)
+gp_labels = dict(zip((gp.split(": ", 1)[0] for gp in group_gp_list), group_gp_list))
+found_codes, positions, missing_codes = utils.find_practices(practice_index, list(gp_labels), key="code")
+found_gps = year_data["practice_display"].iloc[positions].astype(str).tolist()
+missing_gps = [gp_labels[code] for code in missing_codes]
+# If a practice isn't found in the dataset an error is printed for it
+for gp in missing_gps:
+    st.write(f"{gp} is not available in this time period")
+
+# If none of the practices are found, print an error message to say there are no practices from the place available
+if not found_gps:
     st.write("No GP Practices in this Place are available in this time period")
+    # The places aren't calculated when the page stops here, so the upload progress bar is cleared rather than left at the start
+    if upload_progress is not None:
+        upload_progress.empty()
     st.stop()
 
-# bounds method https://stackoverflow.com/a/58185815
-# Sets the bounds of the map; ensures all markers are visible with a margin added to the latitude
-map.fit_bounds(
-    [[min(lat) - 0.02, min(long)], [max(lat) + 0.02, max(long)]]
-)
+# The map HTML is cached for each set of practices, in a cache shared by all sessions that is held with the year's data (so it is dropped when the data changes)
+# Switching back to a place, or to a place another user has viewed, reuses its map rather than drawing it again
+map_cache = registry.derive(selected_year, "map_cache", lambda data: utils.ResultCache(config['map_cache_size']))
+map_key = tuple(sorted(positions.tolist()))
+map_html = map_cache.get(map_key)
+if map_html is None:
+    # Retrieves the practices' latitudes and longitudes from the coordinate arrays in the index
+    map_html = utils.build_map_html(
+        found_gps, practice_index["latitude"][positions], practice_index["longitude"][positions]
+    )
+    map_cache[map_key] = map_html
 
-# Renders the map in Streamlit
-folium_static(map, width=700, height=300)
+# Renders the map in Streamlit, at the same size as streamlit_folium.folium_static
+components.html(map_html, width=700, height=310)
 
 # Creates info boxes showing the relevant year and practices displayed
 # Cleans the list of group_gp_list practices, removing colons, single quotes, and square brackets
@@ -566,24 +589,33 @@ list_of_gps = re.sub(
     str(group_gp_list).replace("'", "").replace("[", "").replace("]", ""),
 )
 # Displays the selected_year defined above in a string for user info
-st.info(f"This information pertains to the **{selected_year.replace("_","/")}** time period")
+st.info(f"This information pertains to the **{selected_year.replace('_','/')}** time period")
 # Displays the selected practices from list_of_gps in a string for user info
 st.info("**Selected GP Practices:**" + list_of_gps)
 
-# The below query strings are used in the get_data_for_all_years function to filter the dataset to the selected place and ICB before aggregating
-# Prepares a query string to filter the practice_display field by value in place_state (see utils)
-gp_query = "practice_display == @place_state"
-# Prepares a query string to filter the "ICB name" field by the value in icb_state (see utils)
-# Escape column names with backticks https://stackoverflow.com/a/56157729
-icb_query = "`ICB name` == @icb_state"
-
 
 # Metrics
 # -------------------------------------------------------------------------
-# Aggregates data and calculates indices for all places and ICBs in session_state, stored in a library
-data_all_years = utils.get_data_for_all_years(dataset_dict, st.session_state, aggregations, index_numerator, index_names, gp_query, icb_query)
-# Filters the data_all_years dataframe to only records for the selected year and where the "Place / ICB" matches to the selection from the drop-down menu
-df = data_all_years[selected_year].loc[data_all_years[selected_year]["Place / ICB"] == st.session_state.after]
+utils.stage("Metrics")
+# Aggregates data and calculates indices for all places and ICBs in session_state, for the selected year only
+# The ICB totals and indices don't depend on the places, so they come from a table built once per year
+icb_table = registry.derive(selected_year, "icb_table", utils.build_icb_table)
+# Each place's results are kept in the shared results cache, so saving or deleting a place only recalculates that place, and places
+# calculated by any session are reused. The version of the year's data file is part of the key, so results for old data are never used
+# After an upload, the progress bar in the sidebar follows the places as they are calculated
+if upload_progress is not None:
+    def report_progress(done, total):
+        upload_progress.progress(done / total if total else 1.0, text=f"Calculating places... {done} of {total}")
+else:
+    report_progress = None
+data_selected_year = utils.get_data_for_all_years({selected_year: year_data}, st.session_state, aggregations, index_numerator, index_names, icb_tables={selected_year: icb_table}, place_cache=result_cache, progress=report_progress, versions={selected_year: registry.version(selected_year)})[selected_year]
+if upload_progress is not None:
+    upload_progress.empty()
+if cache_status is not None:
+    cache_stats = result_cache.stats()
+    cache_status.caption(f"Shared results cache: {cache_stats['entries']:,} of {cache_stats['maxsize']:,} places held, {cache_stats['hits']:,} hits, {cache_stats['misses']:,} misses")
+# Filters the data_selected_year dataframe to only records where the "Place / ICB" matches to the selection from the drop-down menu
+df = data_selected_year.loc[data_selected_year["Place / ICB"] == st.session_state.after]
 # Resets the index of the data frame to account for records filtered out above records
 df = df.reset_index(drop=True)
 
@@ -706,8 +738,93 @@ with st.expander("Primary Care Weighted Populations Update", expanded = True):
         \n\n These errors have now been corrected. The weighted populations in the place-based tool have been updated to reflect these changes as there were a small number of practices that are substantially affected. ICB allocations will not be updated as the recalculation has a small impact at ICB level and this is also mitigated by convergence policy. Therefore, the practice weighted populations and need indices in the place based tool will be different to those published in workbook K (primary medical care 2025-26)."""
     )
 
+# Standard Geographies
+# -------------------------------------------------------------------------
+utils.stage("Standard geographies")
+# Looks the figures for standard geographies up in the rollup cube, which is built once per year and cached next to the data
+if show_standard_geographies:
+    st.subheader("Standard Geographies")
+    rollup = registry.derive(selected_year, "rollup", lambda data: utils.read_cached_rollup(registry.path(selected_year), data))
+    # Only offers the levels the data has codes for
+    rollup_levels = [level for level in utils.ROLLUP_LEVELS if level in set(rollup["Level"])]
+    rollup_level = st.selectbox("Geography", rollup_levels, index=rollup_levels.index("ICB") if "ICB" in rollup_levels else 0)
+    st.caption("Need indices for standard geographies are relative to England (where the national need index = 1.00).")
+    st.dataframe(utils.get_rollup_level(rollup, rollup_level, index_numerator, index_names), hide_index=True)
+    with st.expander("Your places relative to England"):
+        st.caption("The need indices of the places you created, relative to England rather than to their ICB.")
+        st.dataframe(utils.get_national_place_indices(year_data, st.session_state, rollup, aggregations, index_numerator, index_names), hide_index=True)
+
+# Compare Time Periods
+# -------------------------------------------------------------------------
+utils.stage("Compare time periods")
+# Calculates every place and ICB for every time period in one pass, with the year-on-year change in each index
+# The time periods are read through the registry one at a time, so no more are held in memory than max_loaded_years
+if compare_time_periods:
+    st.subheader("Trends Across Time Periods")
+    longitudinal_data = utils.get_longitudinal_data(
+        registry, st.session_state, aggregations, index_numerator, index_names
+    )
+    longitudinal_data["Year"] = longitudinal_data["Year"].str.replace("_", "/")
+    # Charts the headline indices of the selected place over time, when there is more than one time period
+    place_trend = longitudinal_data.loc[longitudinal_data["Place / ICB"] == st.session_state.after]
+    if place_trend["Year"].nunique() > 1:
+        st.line_chart(place_trend, x="Year", y=["Overall Core Index", "Primary Medical Care Index"])
+    if longitudinal_data["Practices not available"].any():
+        st.caption("Practices not available are practices in a place that aren't in the data for that time period; the place is calculated without them")
+    st.dataframe(longitudinal_data, hide_index=True)
+
+# Compare Place Designs
+# -------------------------------------------------------------------------
+utils.stage("Compare place designs")
+# Evaluates alternative ways of splitting an ICB into places (by LA District, PCN or Location, the places saved in this session, or uploaded designs) in one pass
+if compare_place_designs:
+    st.subheader("Compare Place Designs")
+    st.caption("Designs are ranked by how much the need index varies between their places (the GP population weighted standard deviation of the place indices).")
+    design_icb = st.selectbox("ICB", icb, index=icb.index(icb_name) if icb_name in icb else 0, key="design_icb")
+    design_columns = st.multiselect("Split the ICB by", utils.GROUPING_COLUMNS, default=utils.GROUPING_COLUMNS)
+    design_index = st.selectbox("Rank designs on", index_names, index=index_names.index("Overall Core Index"))
+    include_session_places = st.checkbox("Include the places saved in this session as a design", value=True)
+    design_file = st.file_uploader(
+        "Upload candidate designs as JSON",
+        type=["json"],
+        help='A JSON object of {"design name": {"place name": ["practice", ...], ...}, ...}, with practices named as in the sidebar',
+    )
+
+    # Builds the membership table of every design to compare
+    memberships = [utils.build_grouping_membership(year_data, design_icb, design_columns)]
+    if include_session_places:
+        session_places = {
+            place: st.session_state[place]["gps"]
+            for place in st.session_state.places
+            if st.session_state[place]["icb"] == design_icb
+        }
+        memberships.append(utils.build_design_membership({"Places in this session": session_places}))
+    if design_file is not None:
+        try:
+            memberships.append(utils.build_design_membership(json.load(design_file)))
+        except (ValueError, AttributeError, TypeError):
+            st.error("Could not read the candidate designs; please check the file is in the format described")
+
+    # The designs are compared on the unrounded figures, which are then rounded for display as in the download
+    design_results = utils.evaluate_designs(
+        year_data, design_icb, pd.concat(memberships, ignore_index=True), icb_table=icb_table, rounded=False
+    )
+    design_comparison = utils.compare_designs(design_results, year_data, design_icb, design_index)
+    design_results = utils.round_results(design_results, index_numerator, index_names)
+    # A grouping gives no design when none of the ICB's practices have a value for it, e.g. blank PCN codes
+    for column in design_columns:
+        if column not in set(design_comparison["Design"]):
+            st.info(f"No design available for {column}: none of the practices in {design_icb} have a {column} for this time period")
+    if design_comparison.empty:
+        st.warning(f"None of the designs have any practices in {design_icb} for this time period")
+    else:
+        st.dataframe(design_comparison, hide_index=True)
+        with st.expander("Places in each design"):
+            st.dataframe(design_results, hide_index=True)
+
 # Downloads
 # -------------------------------------------------------------------------
+utils.stage("Downloads")
 # Gets the current date and time and stores it as a string formatted YYYY-MM-DD
 current_date = datetime.now().strftime("%Y-%m-%d")
 
@@ -715,10 +832,17 @@ st.subheader("Download Data")
 
 # Creates a checkbox labelled "Preview data download", which is ticked by default
 print_table = st.checkbox("Preview data download", value=True)
-# If the print_table checkbox is ticked, uses the write_table function to display the data loaded using the "get_data_for_all_years" function, filtered for the currently selected year
+# If the print_table checkbox is ticked, uses the write_table function to display the data loaded using the "get_data_for_all_years" function for the currently selected year
+# Only one page of rows is sent to the browser at a time, so the preview stays quick with hundreds of places
 if print_table:
     with st.container():
-        utils.write_table(data_all_years[selected_year])
+        page_size = config['preview_page_size']
+        page_count = utils.get_page_count(len(data_selected_year), page_size)
+        page = 1
+        if page_count > 1:
+            page = st.number_input("Page", min_value=1, max_value=page_count, value=1, step=1)
+            st.caption(f"Rows {(page - 1) * page_size + 1:,} to {min(page * page_size, len(data_selected_year)):,} of {len(data_selected_year):,}")
+        utils.write_table(data_selected_year, page, page_size)
 
 # Content that is added to the first four lines of the downloaded Excel file.
 csv_header1 = f"""PLEASE READ: Below you can find the results for the places you created, and for the ICB they belong to, for the year you selected. This data was last updated: {last_folder_update}"""
@@ -726,60 +850,34 @@ csv_header2 = "Note that the need indices for the places are relative to the ICB
 csv_header3 = "This means that the need indices of the individual places cannot be compared to the need index of the ICB. For more information, see the FAQ tab available in the tool."
 csv_header4 = ""
 
-# Create a BytesIO buffer to store the Excel file while it's being populated
-excel_buffer = io.BytesIO()
-
-# Writes to the excel_buffer file
-with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
-    
-    # Loops through each key/value pair in the data_all_years dictionary
-    for year, df in data_all_years.items():
-        # Sets the name for each tab in the workbook, appending the year to the end (32 characters max)
-        worksheet_name = f"Allocations for {year}"
-        # Adds a worksheet with the set name, replacing "/" with "_"
-        worksheet = writer.book.add_worksheet(worksheet_name.replace("/", "_"))
-        # Uses the write_headers function to add the headers to the sheet and return the correct row to load the data from, start_row
-        start_row = utils.write_headers(worksheet, csv_header1, csv_header2, csv_header3, csv_header4)
-        # Uses write_row from xlsxwriter to write the column names from the df at the start_row
-        worksheet.write_row(start_row, 0, df.columns)
-        # 
-        for r, row in enumerate(df.values, start=start_row+1):
-            worksheet.write_row(r,0,row)
-    # Save the Excel file
-    writer.close()
-
-# Move the pointer of the buffer to the beginning (by default sits at the end of the data written to the buffer)
-excel_buffer.seek(0)
-
-# Open the text documentation file
-with open("docs/ICB allocation tool documentation.txt", "rb") as fh:
-    readme_text = io.BytesIO(fh.read())
+csv_headers = [csv_header1, csv_header2, csv_header3, csv_header4]
 
 # Create JSON dump of the session state (example)
 session_state_dict = dict.fromkeys(st.session_state.places, [])
 for key, value in session_state_dict.items():
     session_state_dict[key] = st.session_state[key]
 session_state_dict["places"] = st.session_state.places
-session_state_dump = json.dumps(session_state_dict, indent=4, sort_keys=False)
-
-# Create a ZIP file containing the Excel file, documentation, and configuration
-zip_buffer = io.BytesIO()
-with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-    zip_file.writestr(f"ICB allocation calculations.xlsx", excel_buffer.getvalue())
-    zip_file.writestr("ICB allocation tool documentation.txt", readme_text.getvalue())
-    zip_file.writestr("ICB allocation tool configuration file.json", session_state_dump)
-
-# Ensure the ZIP file buffer's pointer is at the start
-zip_buffer.seek(0)
-
-# Streamlit download button
-btn = st.download_button(
-    label="Download ZIP",
-    data=zip_buffer.getvalue(),
-    file_name=f"ICB allocation tool {current_date}.zip",
-    mime="application/zip",
+session_state_dump = utils.write_session(session_state_dict).decode("utf-8")
+
+# The download is identified by a hash of everything that goes into it: the session data, the version of each year's data, and the headers
+# It is only built when the user asks for it, and then reused until any of those change
+export_key = utils.get_content_hash(
+    session_state_dump, [(year, registry.version(year)) for year in registry.years], csv_headers
 )
+if st.session_state.get("export_key") != export_key:
+    if st.button("Prepare ZIP download", help="Builds the Excel file of results for all time periods, with the documentation and session data"):
+        st.session_state.export_key = export_key
+
+if st.session_state.get("export_key") == export_key:
+    # Streamlit download button
+    btn = st.download_button(
+        label="Download ZIP",
+        data=build_download_zip(export_key, session_state_dict, csv_headers),
+        file_name=f"ICB allocation tool {current_date}.zip",
+        mime="application/zip",
+    )
 
+utils.stage("Notes")
 # Expander box with notes text
 with st.expander("Notes", expanded = True):
     st.markdown(
@@ -827,4 +925,24 @@ st.info(f"""App last updated: {last_commit_date}
 # -------------------------------------------------------------------------
 if see_session_data:
     st.subheader("Session Data")
-    st.session_state
\ No newline at end of file
+    st.session_state
+
+# Performance
+# -------------------------------------------------------------------------
+# Shows how long each stage of this rerun took, and the timed compute functions within each stage, in the Performance expander
+if profiler is not None:
+    profiler.stop()
+    if performance_panel is not None:
+        with performance_panel:
+            st.caption(f"This rerun took {profiler.total * 1000:,.1f} ms")
+            timings = pd.DataFrame(profiler.records(), columns=["name", "depth", "seconds"])
+            st.dataframe(
+                pd.DataFrame({
+                    # Indents the timed functions under the stage that called them
+                    "Stage": ["\u2003" * depth + name for name, depth in zip(timings["name"], timings["depth"])],
+                    "ms": (timings["seconds"] * 1000).round(1),
+                }),
+                hide_index=True,
+            )
+            st.download_button("Download timings as JSON", profiler.to_json(), file_name="timings.json", mime="application/json")
+            st.download_button("Download timings for Prometheus", profiler.to_prometheus(), file_name="timings.prom", mime="text/plain")
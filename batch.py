@@ -0,0 +1,156 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+FILE:           batch.py
+DESCRIPTION:    Command-line tool to calculate the place indices for a folder of session files, without Streamlit
+CONTACT:        england.revenue-allocations@nhs.net
+CREATED:        2026-10-17
+
+Usage:
+    python batch.py <folder of session files> <output .csv, .parquet or .xlsx> [--data data/] [--years 2025_2026 ...] [--dtype float64] [--workers 4]
+
+Each session file is in one of the formats written by "Download session data" in the tool (.json, .json.gz or .msgpack,
+see compute.sessions), including session files from before the format was versioned. The results for every
+place (and the ICBs they belong to) in every session and year are written to a single output file, with "Session" and
+"Year" columns added in front of the columns of the tool's download.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+# python
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# local
+import compute
+
+# 3rd party:
+import pandas as pd
+
+
+# Extensions of the session files read from the sessions folder
+SESSION_EXTENSIONS = (".json", ".json.gz", ".msgpack")
+
+# Each worker process keeps its own registry, so each year is only loaded once per worker, and its own results cache,
+# so a place that appears in several session files is only calculated once per worker
+registry = None
+result_cache = None
+
+
+def init_worker(data_folder, max_loaded, population_dtype):
+    """Creates the dataset registry and results cache for a worker process."""
+    global registry, result_cache
+    registry = compute.DatasetRegistry(data_folder, max_loaded, population_dtype)
+    result_cache = compute.ResultCache()
+
+
+def process_session(path, years):
+    """
+    Calculates the indices for every place in a session file, for each of the given years.
+
+    Parameters:
+    path: The location of the session file.
+    years: The years to calculate, as listed in the registry, e.g. ['2025_2026'].
+
+    Returns:
+    results: A df with the rows of the tool's download for each year, with "Session" and "Year" columns added at the front
+    place_count: The number of places in the session
+    """
+    with open(path, "rb") as fh:
+        places = compute.parse_session(fh.read())
+    filename = os.path.basename(path)
+    session_name = next(filename[:-len(extension)] for extension in SESSION_EXTENSIONS[::-1] if filename.endswith(extension))
+    frames = []
+    place_count = 0
+    for year in years:
+        # Matches the practices to each year on their codes, so practices renamed between years are still found
+        session, _ = compute.resolve_session(places, registry.get(year))
+        place_count = max(place_count, len(session["places"]))
+        df = compute.get_data_for_all_years(
+            {year: registry.get(year)},
+            session,
+            compute.AGGREGATIONS,
+            compute.INDEX_NUMERATOR,
+            compute.INDEX_NAMES,
+            icb_tables={year: registry.derive(year, "icb_table", compute.build_icb_table)},
+            place_cache=result_cache,
+            versions={year: registry.version(year)},
+        )[year]
+        df.insert(loc=0, column="Year", value=year)
+        df.insert(loc=0, column="Session", value=session_name)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True), place_count
+
+
+def write_output(results, path):
+    """Writes the results to a .csv, .parquet or .xlsx file, depending on the extension of path."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        results.to_csv(path, index=False)
+    elif extension == ".parquet":
+        results.to_parquet(path, index=False)
+    elif extension == ".xlsx":
+        results.to_excel(path, index=False, engine="xlsxwriter")
+    else:
+        raise ValueError(f"Unsupported output format '{extension}', use .csv, .parquet or .xlsx")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calculate place indices for a folder of session JSON files.")
+    parser.add_argument("sessions", help="Folder containing the session .json, .json.gz or .msgpack files")
+    parser.add_argument("output", help="File to write the results to (.csv, .parquet or .xlsx)")
+    parser.add_argument("--data", default="data/", help="Folder containing the yearly CSVs (default: data/)")
+    parser.add_argument("--years", nargs="+", help="Years to calculate, e.g. 2025_2026 (default: every year in the data folder)")
+    parser.add_argument(
+        "--dtype", default="float64", choices=["float64", "float32"], help="Dtype of the population columns (default: float64)"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    years = args.years or compute.DatasetRegistry(args.data).years
+    paths = sorted(
+        os.path.join(args.sessions, filename)
+        for filename in os.listdir(args.sessions)
+        if filename.endswith(SESSION_EXTENSIONS)
+    )
+    if not paths:
+        parser.error(f"No session files found in {args.sessions}")
+
+    start = time.perf_counter()
+    frames = []
+    place_count = 0
+    failures = 0
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker, initargs=(args.data, len(years), args.dtype)
+    ) as executor:
+        futures = {path: executor.submit(process_session, path, years) for path in paths}
+        for path, future in futures.items():
+            try:
+                results, places = future.result()
+            except Exception as e:
+                print(f"Could not process {path}: {e}", file=sys.stderr)
+                failures += 1
+                continue
+            frames.append(results)
+            place_count += places
+    elapsed = time.perf_counter() - start
+
+    if frames:
+        write_output(pd.concat(frames, ignore_index=True), args.output)
+    print(
+        f"Processed {place_count} places from {len(paths) - failures} session files over {len(years)} years "
+        f"in {elapsed:.2f}s ({place_count / elapsed:.1f} places per second)",
+        file=sys.stderr,
+    )
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
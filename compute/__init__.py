@@ -0,0 +1,90 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+The compute core of the ICB Place Based Allocation Tool: loading the yearly datasets, aggregating places and ICBs,
+calculating the need indices and rounding them.  It only depends on pandas, NumPy and (for the data cache) pyarrow,
+so it can be used outside the Streamlit app, e.g. by batch.py.
+
+The functions are imported from their modules when first used, so "import compute" itself is almost instant.
+"""
+
+import importlib
+
+# Where each public name is defined
+_EXPORTS = {
+    "cached": "caching",
+    "set_cache_backend": "caching",
+    "get_cache_backend": "caching",
+    "lru_backend": "caching",
+    "ResultCache": "caching",
+    "Profiler": "profiling",
+    "start_profiler": "profiling",
+    "get_profiler": "profiling",
+    "span": "profiling",
+    "stage": "profiling",
+    "timed": "profiling",
+    "DATA_CACHE_VERSION": "loading",
+    "DATA_CACHE_FOLDER": "loading",
+    "read_data": "loading",
+    "get_data_cache_path": "loading",
+    "get_file_hash": "loading",
+    "read_cached_data": "loading",
+    "read_cached_frame": "loading",
+    "get_data": "loading",
+    "DatasetRegistry": "loading",
+    "build_practice_index": "loading",
+    "build_selection_index": "loading",
+    "select_practices": "loading",
+    "find_practices": "loading",
+    "AGGREGATIONS": "aggregation",
+    "INDEX_NUMERATOR": "aggregation",
+    "INDEX_NAMES": "aggregation",
+    "aggregate": "aggregation",
+    "get_index": "aggregation",
+    "get_icb_index": "aggregation",
+    "get_place_index": "aggregation",
+    "build_icb_table": "aggregation",
+    "build_membership": "aggregation",
+    "build_membership_matrix": "aggregation",
+    "aggregate_membership_matrix": "aggregation",
+    "aggregate_places": "aggregation",
+    "round_results": "aggregation",
+    "get_data_for_all_years": "aggregation",
+    "get_longitudinal_data": "aggregation",
+    "GROUPING_COLUMNS": "scenarios",
+    "build_grouping_membership": "scenarios",
+    "build_design_membership": "scenarios",
+    "evaluate_designs": "scenarios",
+    "compare_designs": "scenarios",
+    "SESSION_VERSION": "sessions",
+    "SESSION_ENCODINGS": "sessions",
+    "iter_session_items": "sessions",
+    "write_session": "sessions",
+    "parse_session": "sessions",
+    "resolve_session": "sessions",
+    "import_session": "sessions",
+    "ROLLUP_LEVELS": "rollup",
+    "build_rollup": "rollup",
+    "read_cached_rollup": "rollup",
+    "get_rollup_level": "rollup",
+    "get_national_place_indices": "rollup",
+    "excel_round": "rounding",
+    "excel_round_array": "rounding",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f"{__name__}.{module}"), name)
+
+
+def __dir__():
+    return __all__
@@ -0,0 +1,659 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Aggregating practices into places and ICBs, and calculating the need indices.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from compute.caching import ResultCache
+from compute.loading import DatasetRegistry
+from compute.profiling import timed
+from compute.rounding import excel_round_array
+from compute.sessions import match_practice_codes
+
+
+# Create aggregations dictionary, used in get_data_for_all_years function; tells function how to aggregate each column
+AGGREGATIONS = {
+    "GP pop": "sum",
+    "Weighted G&A pop": "sum",
+    "Weighted Community pop": "sum",
+    "Weighted Mental Health pop": "sum",
+    "Weighted Maternity pop": "sum",
+    "Weighted Prescribing pop": "sum",
+    "Overall Weighted pop": "sum",
+    "Weighted Primary Care": "sum",
+    "Weighted Primary Medical Care Need": "sum",
+    "Weighted Health Inequalities pop": "sum",
+}
+
+# Create index_numerator list, used in get_data_for_all_years function; see get_index for full info
+INDEX_NUMERATOR = [
+    "Weighted G&A pop",
+    "Weighted Community pop",
+    "Weighted Mental Health pop",
+    "Weighted Maternity pop",
+    "Weighted Prescribing pop",
+    "Overall Weighted pop",
+    "Weighted Primary Care",
+    "Weighted Primary Medical Care Need",
+    "Weighted Health Inequalities pop",
+]
+
+# Create index_names list, used in get_data_for_all_years function; see get_index for full info
+INDEX_NAMES = [
+    "G&A Index",
+    "Community Index",
+    "Mental Health Index",
+    "Maternity Index",
+    "Prescribing Index",
+    "Overall Core Index",
+    "Primary Medical Care Index",
+    "Primary Medical Care Need Index",
+    "Health Inequalities Index",
+]
+
+
+# Creates the aggregate function
+def aggregate(df, name, on, aggregations):
+    """
+    Function aggregates a data frame.  How the data is grouped and which aggregations are performed depends on given inputs.
+    Also checks that the df includes the specified "on" column and, if not, creates it, populating it with the name value, before aggregating.
+    No longer called by get_data_for_all_years, which aggregates every place at once using aggregate_places, but kept for aggregating a single pre-filtered place or ICB.
+    
+    Parameters:
+    df: The pre-filtered (using a query string) data from the dataset_dict, containing only a single place or ICB before aggregation.
+    name: The place taken from the session_state.places list, used to populate the "on" field, if it's not already in the data.
+    on: Either the string "Place Name" or "ICB name", telling the function what to group on.  Both variations are called in the get_data_all_years function to create aggregations at both place-level and ICB-level.
+    aggregations: The library of column names and the aggregation functions to be performed on them, defined in the ICB_Place_Based_Tool.py file
+
+    Returns:
+    df: The same df as initially loaded
+    df_group: The aggregated and grouped df
+    """
+    if on not in df.columns:
+        df.insert(loc=0, column=on, value=name)
+
+    df_group = df.groupby(on, observed=True).agg(aggregations)
+
+    return df, df_group
+
+
+# Creates a function to calculate the index of weighted populations.
+def get_index(place_indices, icb_indices, index_names, index_numerator, place_icbs=None):
+    """
+    Calculates the index of weighted populations.
+    Intended to take the df_group output from the aggregate function and divide it by the GP population, for ICB and place.
+    The place index is then divided by the icb index to create a relative number.
+    The overall index is created by final_wp divided by [GP pop].
+    See get_icb_index and get_place_index, which calculate each half.
+    
+    Parameters:
+    place_indices: A df with place-level data
+    icb_indices: A df with ICB-level data
+    index_names: List of the indexes to be created.  Defined in ICB_Place_Based_Tool.py
+    index_numerator: List of column names that contain the numerator values for the index calculation.  Defined in ICB_Place_Based_Tool.py
+    place_icbs: Optional list of the ICB name for each row of place_indices.  When given, icb_indices holds one row per distinct ICB (indexed by "ICB name") and each place is divided by the row for its own ICB.
+                When omitted, icb_indices must already be lined up row-for-row with place_indices.
+
+    Returns:
+    place_indices: Input place_indices df with new index_names column
+    icb_indices: Input icb_indices df with new index_names column
+    """
+    icb_indices = get_icb_index(icb_indices, index_names, index_numerator)
+    place_indices = get_place_index(place_indices, icb_indices, index_names, index_numerator, place_icbs)
+    return place_indices, icb_indices
+
+
+def get_icb_index(icb_indices, index_names, index_numerator):
+    """
+    Calculates the ICB indices of weighted populations, which are relative to national ([index_numerator] / [GP pop]).
+
+    Parameters:
+    icb_indices: A df with ICB-level data
+    index_names: List of the indexes to be created.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+
+    Returns:
+    icb_indices: Input icb_indices df with new index_names column
+    """
+    # Creates a new column in icb_indices called "index_names", containing [index_numerator] / [GP pop]
+    icb_indices[index_names] = icb_indices[index_numerator].div(
+        icb_indices["GP pop"].values, axis=0
+    )
+    return icb_indices
+
+
+def get_place_index(place_indices, icb_indices, index_names, index_numerator, place_icbs=None):
+    """
+    Calculates the place indices of weighted populations, which are relative to the ICB (([index_numerator] / [GP pop]) / ICB index).
+
+    Parameters:
+    place_indices: A df with place-level data
+    icb_indices: A df with ICB-level data that already has its index_names columns (see get_icb_index)
+    index_names: List of the indexes to be created.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    place_icbs: Optional list of the ICB name for each row of place_indices, see get_index.
+
+    Returns:
+    place_indices: Input place_indices df with new index_names column
+    """
+    # Lines the ICB indices up with the places, so each ICB only has to be aggregated once however many places sit within it
+    icb_index = icb_indices[index_names]
+    if place_icbs is not None:
+        icb_index = icb_index.reindex(place_icbs)
+    # Creates a new column in place_indices called "index_names", containing ([index_numerator] / [GP pop]) / ICB index
+    place_indices[index_names] = (
+        place_indices[index_numerator]
+        .div(place_indices["GP pop"].values, axis=0)
+        .div(icb_index.values, axis=0)
+    )
+    return place_indices
+
+
+@timed
+def build_icb_table(data, aggregations=AGGREGATIONS, index_numerator=INDEX_NUMERATOR, index_names=INDEX_NAMES):
+    """
+    Builds the table of summed weighted populations and indices for every ICB in a year's data.
+    This only depends on the data, not on the places in the session, so it is built once per year (see DatasetRegistry.derive) and passed to get_data_for_all_years.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    aggregations: The library of column names and the aggregation functions to be performed on them.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the indexes to be created.
+
+    Returns:
+    icb_table: A df indexed by "ICB name", with the aggregated columns and the ICB indices
+    """
+    # observed=True leaves out the ICBs of the categorical that aren't in data, e.g. when it has been filtered to a few ICBs
+    icb_table = data.groupby("ICB name", sort=False, observed=True).agg(aggregations)
+    icb_table.index = icb_table.index.astype(object)
+    return get_icb_index(icb_table, index_names, index_numerator)
+
+
+def build_membership(session_state):
+    """
+    Builds the practice to place membership table for every place in the session.
+    Each row links one place to one of its GP practices, so a practice that sits in more than one place appears once per place.
+    Duplicate practices within a single place are dropped, matching the behaviour of filtering the data with an "in" query.
+
+    Parameters:
+    session_state: The session state (or a dict with the same layout), containing the "places" list and a {"gps": [...], "icb": ...} entry for each place.
+
+    Returns:
+    membership: A df with "Place Name", "ICB name" and "practice_display" columns, in the order the places were created
+    """
+    rows = [
+        (place, session_state[place]["icb"], gp)
+        for place in session_state["places"]
+        for gp in session_state[place]["gps"]
+    ]
+    membership = pd.DataFrame(rows, columns=["Place Name", "ICB name", "practice_display"])
+    return membership.drop_duplicates(ignore_index=True)
+
+
+def resolve_membership(data, membership):
+    """
+    Matches the practices of a membership table to a year's data on their practice codes, giving each the practice_display value it has in that year.
+    Places hold their practices as the practice_display values of the year they were created or imported in, so a practice renamed
+    in another year would otherwise be missing from it.  Practices whose code isn't in the data are left as they are.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    membership: The practice to place membership table built by build_membership.
+
+    Returns:
+    membership: The table with the practice_display values of the year (a copy, if any are changed), and any practice then listed twice in a place dropped
+    """
+    labels = membership["practice_display"].to_numpy(dtype=object)
+    # Only the practices whose practice_display isn't in the data are looked up on their codes, as matching the codes means a pass over every row of the data.
+    # The categories of a categorical practice_display keep their lookup table between calls, so checking them costs nothing per row
+    display = data["practice_display"]
+    if isinstance(display.dtype, pd.CategoricalDtype):
+        unmatched = display.cat.categories.get_indexer(labels) < 0
+    else:
+        unmatched = ~pd.Index(labels).isin(display)
+    if not unmatched.any():
+        return membership
+    # practice_display values are "CODE: NAME", see read_data
+    positions = match_practice_codes([str(gp).split(": ", 1)[0] for gp in labels[unmatched]], data)
+    found = positions >= 0
+    labels = labels.copy()
+    labels[np.flatnonzero(unmatched)[found]] = display.astype(object).to_numpy()[positions[found]]
+    return membership.assign(practice_display=labels).drop_duplicates(ignore_index=True)
+
+
+def build_membership_matrix(data, membership):
+    """
+    Builds the sparse place x practice membership matrix for a year, in compressed sparse row (CSR) form.
+    Row i of the matrix holds the positions in data of the practices in places[i], so a practice that sits in several places appears in several rows.
+    Practices missing from the data are dropped, and places with none of their practices in the data are left out.
+    Requires practice_display to be unique in data.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    membership: The practice to place membership table built by build_membership.
+
+    Returns:
+    matrix: A dictionary containing
+        "places": the place names, one per row, in the order they first appear in membership
+        "indptr": numpy array, the practices of row i are indices[indptr[i]:indptr[i + 1]]
+        "indices": numpy array of row positions in data, ascending within each row
+    """
+    positions = pd.Index(data["practice_display"]).get_indexer(membership["practice_display"])
+    found = positions >= 0
+    place_codes, places = pd.factorize(membership["Place Name"].to_numpy()[found])
+    positions = positions[found]
+    # Sorts by place, then by position in data, so each place is summed in the same order as the rows of data
+    order = np.lexsort((positions, place_codes))
+    counts = np.bincount(place_codes, minlength=len(places))
+    return {
+        "places": list(places),
+        "indptr": np.concatenate([[0], np.cumsum(counts)]),
+        "indices": positions[order],
+    }
+
+
+def _kahan_reduce(values, indptr):
+    """
+    Sums the rows of values in each slice indptr[i]:indptr[i + 1], using the same compensated (Kahan) summation as pandas' groupby sum, so the results are identical to it.
+    Works through the k-th row of every slice at once, so the number of steps is the size of the largest slice rather than the number of rows.
+    """
+    lengths = np.diff(indptr)
+    # Orders the slices longest first, so the slices still being summed at step k are always the first few
+    order = np.argsort(-lengths, kind="stable")
+    starts = indptr[:-1][order]
+    sorted_lengths = lengths[order]
+    sums = np.zeros((len(lengths), values.shape[1]), dtype=values.dtype)
+    compensation = np.zeros_like(sums)
+    for k in range(sorted_lengths[0] if len(lengths) else 0):
+        active = np.searchsorted(-sorted_lengths, -k, side="left")
+        value = values[starts[:active] + k]
+        y = value - compensation[:active]
+        t = sums[:active] + y
+        compensation[:active] = t - sums[:active] - y
+        # Compensation is NaN if a value is infinite, in which case it is reset as pandas does
+        compensation[:active][np.isnan(compensation[:active])] = 0
+        sums[:active] = t
+    result = np.empty_like(sums)
+    result[order] = sums
+    return result
+
+
+def aggregate_membership_matrix(data, matrix, columns):
+    """
+    Sums the given columns of data for every row of a membership matrix, i.e. the sparse product of the membership matrix and the practice x measure matrix.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    matrix: The membership matrix built by build_membership_matrix for the same data.
+    columns: The columns of data to sum.
+
+    Returns:
+    df_group: A df of the summed columns, indexed by "Place Name", with the same dtypes as data
+    """
+    dtype = np.result_type(*data[columns].dtypes)
+    values = data[columns].to_numpy(dtype=dtype if dtype.kind == "f" else np.float64)
+    sums = _kahan_reduce(values[matrix["indices"]], matrix["indptr"])
+    df_group = pd.DataFrame(sums, index=pd.Index(matrix["places"], name="Place Name"), columns=columns)
+    return df_group.astype(data[columns].dtypes.to_dict())
+
+
+@timed
+def aggregate_places(data, membership, aggregations):
+    """
+    Aggregates the data for every place in the membership table in a single pass.
+    When every aggregation is a sum (as in AGGREGATIONS), the places are summed as a sparse membership matrix product, see build_membership_matrix.
+    Otherwise the data is joined to the membership table on practice_display and then grouped on "Place Name".
+    Either way the cost scales with the number of practices in places rather than rows x places, and overlapping places are allowed.
+    The practices are first matched to the data on their codes (see resolve_membership), so practices renamed since they were added are still found.
+    Places with none of their practices in the data are left out, in the same way as an empty query would return no rows.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    membership: The practice to place membership table built by build_membership.
+    aggregations: The library of column names and the aggregation functions to be performed on them, defined in the ICB_Place_Based_Tool.py file
+
+    Returns:
+    df_group: The aggregated df, indexed by "Place Name"
+    """
+    membership = resolve_membership(data, membership)
+    if all(function == "sum" for function in aggregations.values()) and data["practice_display"].is_unique:
+        matrix = build_membership_matrix(data, membership)
+        return aggregate_membership_matrix(data, matrix, list(aggregations))
+
+    columns = ["practice_display"] + [column for column in aggregations if column != "practice_display"]
+    # An inner merge keeps the rows of data in their original order, so each place is summed in the same order as a query on the data would give
+    df = data[columns].merge(membership[["Place Name", "practice_display"]], on="practice_display")
+    return df.groupby("Place Name", sort=False).agg(aggregations)
+
+
+def round_results(df, index_numerator, index_names):
+    """
+    Rounds calculated results in the same way as Excel would for the download: weighted populations and GP pop to whole numbers, indices to 3 decimal places.
+
+    Parameters:
+    df: A df of aggregated results, with the index_numerator, "GP pop" and index_names columns.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the index columns.
+
+    Returns:
+    df: The same df, rounded
+    """
+    # Numerators and indices are rounded differently
+    df[index_numerator + ["GP pop"]] = excel_round_array(df[index_numerator + ["GP pop"]], 1)
+    df[index_names] = excel_round_array(df[index_names], 0.001)
+    return df
+
+
+# Number of places aggregated at a time when progress is being reported, see get_data_for_all_years
+PROGRESS_CHUNK_SIZE = 250
+
+
+def _calculate_places(data, membership, icb_indices, place_icbs, aggregations, index_numerator, index_names, progress=None):
+    """
+    Aggregates every place in the membership table and calculates their indices, relative to the ICBs in icb_indices.
+    If progress is given, the places are aggregated PROGRESS_CHUNK_SIZE at a time, calling progress(number of places done) after each chunk.
+    """
+    if progress is None:
+        chunks = [membership]
+    else:
+        names = membership["Place Name"].unique()
+        chunks = [
+            membership.loc[membership["Place Name"].isin(names[start:start + PROGRESS_CHUNK_SIZE])]
+            for start in range(0, len(names), PROGRESS_CHUNK_SIZE)
+        ] or [membership]
+    frames = []
+    done = 0
+    for chunk in chunks:
+        place_groupby = aggregate_places(data, chunk, aggregations)
+        frames.append(get_place_index(
+            place_groupby, icb_indices, index_names, index_numerator, place_icbs=place_icbs.loc[place_groupby.index]
+        ))
+        if progress is not None:
+            done += chunk["Place Name"].nunique()
+            progress(done)
+    return frames[0] if len(frames) == 1 else pd.concat(frames)
+
+
+@timed
+def get_data_for_all_years(
+    dataset_dict,
+    session_state,
+    aggregations,
+    index_numerator,
+    index_names,
+    icb_tables=None,
+    place_cache=None,
+    progress=None,
+    versions=None,
+):
+    """
+    Processes and aggregates data for all datasets across multiple years.
+
+    This function iterates over all datasets in the given `dataset_dict`, aggregates data for each place
+    and Integrated Care Board (ICB) specified in the `session_state`, and calculates indices based on the 
+    provided aggregation functions. The aggregated and indexed data is then stored back in 
+    the `dataset_dict` for each dataset.
+
+    The practice to place membership table is built once, then every place is aggregated in one grouped
+    pass per year and each distinct ICB is aggregated only once, however many places sit within it (or not at all,
+    if a precomputed ICB table is given for the year).
+
+    Parameters:
+    ----------
+    dataset_dict : dict
+        A dictionary where the keys are filenames and the values are corresponding datasets (DataFrames). When called in the tool this is the imported data with a dataframe for each year.
+        
+    session_state : object
+        An object that contains the session state, including a list of places and corresponding 
+        geographical and ICB information for each place.
+        
+    aggregations : dict
+        A dictionary specifying the aggregation functions to apply to the data. The keys are column names
+        and the values are aggregation functions (e.g., 'sum', 'mean').
+
+    index_numerator : str
+        The column name to use as the numerator for index calculations.
+
+    index_names : list
+        A list of column names to use as the denominator for index calculations.
+
+    icb_tables : dict, optional
+        The precomputed ICB table (see build_icb_table) for each key of `dataset_dict`. ICBs are looked up in these
+        rather than aggregated; any year without a table has the ICBs in the session aggregated from its data.
+
+    place_cache : dict or ResultCache, optional
+        The unrounded results of each place from earlier calls, keyed by (key of `dataset_dict`, version, ICB, frozenset of
+        practice codes), which is updated in place. Only places without a cached row are aggregated. A dict belongs to one
+        session, so its rows for this year that no longer match a place in the session are dropped; a ResultCache
+        (see compute.caching) is shared between sessions and bounds its own size instead.
+
+    versions : dict, optional
+        The version of each key of `dataset_dict` (e.g. DatasetRegistry.version), which is part of the place_cache keys so
+        rows calculated from an older copy of a year's data are never used. Without it, the caller is responsible for
+        clearing the cache when a year's data changes.
+
+    progress : callable, optional
+        Called as progress(done, total) as the places are calculated, where total is the number of places times the
+        number of years, e.g. to drive a progress bar. Places are then aggregated a few hundred at a time.
+
+    Returns:
+    -------
+    dict
+        The updated `dataset_dict` where each dataset (DataFrame) has been aggregated, indexed, and rounded 
+        to three decimal places. Each dataset is a DataFrame with data aggregated at the ICB and place level.
+        Rows are grouped by ICB, in the order the ICBs first appear in the session, with each ICB followed by its places.
+
+    """
+    places = list(session_state["places"])
+    # Looks up the ICB for each place, and the list of distinct ICBs in the order they first appear
+    place_icbs = pd.Series({place: session_state[place]["icb"] for place in places}, dtype=object)
+    icbs = list(dict.fromkeys(place_icbs))
+    # Position of each ICB and place, used to put the rows back into session order after aggregating
+    icb_order = {icb: position for position, icb in enumerate(icbs)}
+    place_order = {place: position for position, place in enumerate(places)}
+
+    # The membership table only depends on the session, so it is built once and reused for every year
+    membership = build_membership(session_state)
+
+    # Reports the number of places done so far, out of the places in every year
+    total = len(places) * len(dataset_dict)
+
+    def report(done):
+        if progress is not None:
+            progress(done, total)
+
+    if place_cache is not None:
+        # Key for each place's results: the same practices in the same ICB always give the same row for a version of a year
+        # The practices are keyed on their codes, which they are matched to each year on (see resolve_membership), so a renamed practice keeps its rows
+        place_keys = {
+            place: (place_icbs[place], frozenset(str(gp).split(": ", 1)[0] for gp in session_state[place]["gps"])) for place in places
+        }
+        # Columns of the cached rows: the aggregations followed by the indices
+        columns = list(aggregations) + [name for name in index_names if name not in aggregations]
+
+    for year_number, (filename, data) in enumerate(dataset_dict.items()):
+        year_start = year_number * len(places)
+        # get ICB aggregations and indices, from the precomputed table for the year if there is one
+        if icb_tables is not None and filename in icb_tables:
+            icb_table = icb_tables[filename]
+        else:
+            icb_table = build_icb_table(data.loc[data["ICB name"].isin(icbs)], aggregations, index_numerator, index_names)
+        icb_indices = icb_table.loc[[icb for icb in icbs if icb in icb_table.index]].copy()
+
+        if place_cache is None:
+            # get place aggregations and indices, for all places at once
+            place_indices = _calculate_places(
+                data,
+                membership,
+                icb_indices,
+                place_icbs,
+                aggregations,
+                index_numerator,
+                index_names,
+                progress=None if progress is None else lambda done: report(year_start + done),
+            )
+        else:
+            version = None if versions is None else versions.get(filename)
+            year_keys = {place: (filename, version) + key for place, key in place_keys.items()}
+            # Looks every place up once, keeping the rows found, so a shared cache can't drop them before they are used
+            missing = object()
+            rows = {place: place_cache.get(year_keys[place], missing) for place in places}
+            # Only the places that aren't cached (new, changed or evicted since they were calculated) are aggregated
+            new_places = [place for place in places if rows[place] is missing]
+            # The places already in the cache count as done
+            cached_count = len(places) - len(new_places)
+            report(year_start + cached_count)
+            if new_places:
+                new_indices = _calculate_places(
+                    data,
+                    membership.loc[membership["Place Name"].isin(new_places)],
+                    icb_indices,
+                    place_icbs,
+                    aggregations,
+                    index_numerator,
+                    index_names,
+                    progress=None if progress is None else lambda done: report(year_start + cached_count + done),
+                )
+                for place in new_places:
+                    # Places with none of their practices in the data are cached as None, so they are left out again
+                    rows[place] = new_indices.loc[place, columns].to_numpy() if place in new_indices.index else None
+                    place_cache[year_keys[place]] = rows[place]
+
+            if not isinstance(place_cache, ResultCache):
+                # Drops the cached rows for this year that no longer match a place in the session (deleted or edited places)
+                current_keys = set(year_keys.values())
+                for key in [key for key in place_cache if key[0] == filename and key not in current_keys]:
+                    del place_cache[key]
+
+            # Reassembles the place results from the cached rows
+            cached_places = [place for place in places if rows[place] is not None]
+            place_indices = pd.DataFrame(
+                np.array([rows[place] for place in cached_places]).reshape(len(cached_places), len(columns)),
+                index=pd.Index(cached_places, name="Place Name"),
+                columns=columns,
+            )
+
+        icb_indices.insert(loc=0, column="Place / ICB", value=icb_indices.index)
+        place_indices.insert(loc=0, column="Place / ICB", value=place_indices.index)
+
+        # Sort keys put each ICB first, followed by its places in the order they were created
+        icb_sort_keys = pd.DataFrame({"icb": icb_indices.index.map(icb_order), "place": -1})
+        place_sort_keys = pd.DataFrame({
+            "icb": place_icbs.loc[place_indices.index].map(icb_order).values,
+            "place": place_indices.index.map(place_order),
+        })
+        keys = pd.concat([icb_sort_keys, place_sort_keys], ignore_index=True)
+        order = keys.sort_values(["icb", "place"], kind="stable").index
+
+        large_df = pd.concat([icb_indices, place_indices], ignore_index=True)
+        large_df = large_df.loc[order].reset_index(drop=True)
+
+        # Rounding the data here, after calculations are done to maintain accuracy
+        dataset_dict[filename] = round_results(large_df, index_numerator, index_names)
+        # Places with none of their practices in the data are never aggregated, so the year is marked as done here
+        report(year_start + len(places))
+
+    return dataset_dict
+
+
+@timed
+def get_longitudinal_data(datasets, session_state, aggregations, index_numerator, index_names):
+    """
+    Calculates every place and ICB in the session for every year, as one long table keyed by (year, place), with the year-on-year change in each index.
+    The years are stacked into one frame and aggregated with a single grouped pass, rather than once per year, giving the same figures as get_data_for_all_years.
+    The practices of each place are matched to each year on their codes, so a practice renamed between years is counted in every year it is in.
+
+    Parameters:
+    datasets: A dictionary of year -> the practice-level data for that year, as returned by get_data, or a DatasetRegistry.
+              The years of a registry are loaded one at a time, and only the rows of the places' practices and ICBs are kept
+              from each, so no more years are held in memory than the registry allows.
+    session_state: The session state (or a dict with the same layout), containing the "places" list and a {"gps": [...], "icb": ...} entry for each place.
+    aggregations: The library of column names and the aggregation functions to be performed on them.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the indexes to be created.
+
+    Returns:
+    df: A df with "Year" and "Place / ICB" columns followed by the columns of the tool's download, a "Practices not available" column counting the
+        place's practices that aren't in the year's data, and a "<index> change" column for each index (blank for a place's first year).
+        Rows are grouped by ICB and place in session order, as in get_data_for_all_years, with the years in order within each.
+        Places with none of their practices in a year are left out of that year.
+    """
+    years = sorted(datasets.years if isinstance(datasets, DatasetRegistry) else datasets)
+    places = list(session_state["places"])
+    place_icbs = pd.Series({place: session_state[place]["icb"] for place in places}, dtype=object)
+    icbs = list(dict.fromkeys(place_icbs))
+    icb_order = {icb: position for position, icb in enumerate(icbs)}
+    place_order = {place: position for position, place in enumerate(places)}
+    year_order = {year: position for position, year in enumerate(years)}
+    membership = build_membership(session_state)
+
+    # Stacks the years into one frame, keeping each year's rows in their original order so the sums match the single year calculation.
+    # Each year's practices are joined to the places on their codes (see resolve_membership), so practices renamed between years are still found
+    columns = ["practice_display", "ICB name"] + [column for column in aggregations if column not in ("practice_display", "ICB name")]
+    place_frames = []
+    icb_frames = []
+    missing = []
+    for year in years:
+        data = datasets.get(year)
+        year_membership = resolve_membership(data, membership)
+        year_data = data[columns].assign(Year=year).astype({"practice_display": object, "ICB name": object})
+        place_frames.append(year_data.merge(year_membership[["Place Name", "practice_display"]], on="practice_display"))
+        icb_frames.append(year_data.loc[year_data["ICB name"].isin(icbs)])
+        # Counts the practices of each place that aren't in the year's data
+        missing.append(
+            year_membership.assign(Year=year, missing=~year_membership["practice_display"].isin(year_data["practice_display"]))
+            .groupby(["Year", "Place Name"], sort=False)["missing"].sum()
+        )
+    missing = pd.concat(missing)
+
+    # get place and ICB aggregations, for every year at once
+    place_groupby = pd.concat(place_frames, ignore_index=True).groupby(["Year", "Place Name"], sort=False).agg(aggregations)
+    icb_groupby = pd.concat(icb_frames, ignore_index=True).groupby(["Year", "ICB name"], sort=False).agg(aggregations)
+
+    # index calcs, each place relative to its ICB in the same year
+    icb_indices = get_icb_index(icb_groupby, index_names, index_numerator)
+    place_years = place_groupby.index.get_level_values("Year")
+    place_names = place_groupby.index.get_level_values("Place Name")
+    place_indices = get_place_index(
+        place_groupby,
+        icb_indices,
+        index_names,
+        index_numerator,
+        place_icbs=pd.MultiIndex.from_arrays([place_years, place_icbs.loc[place_names].values]),
+    )
+
+    icb_rows = icb_indices.reset_index().rename(columns={"ICB name": "Place / ICB"})
+    icb_rows.insert(loc=2, column="Practices not available", value=0)
+    place_rows = place_indices.reset_index().rename(columns={"Place Name": "Place / ICB"})
+    place_rows.insert(
+        loc=2,
+        column="Practices not available",
+        value=missing.reindex(pd.MultiIndex.from_arrays([place_years, place_names]), fill_value=0).to_numpy(),
+    )
+
+    # Sort keys put each ICB first, followed by its places in the order they were created, with the years in order within each
+    keys = pd.DataFrame({
+        "icb": list(icb_rows["Place / ICB"].map(icb_order)) + list(place_icbs.loc[place_names].map(icb_order)),
+        "place": [-1] * len(icb_rows) + list(place_names.map(place_order)),
+        "year": list(icb_rows["Year"].map(year_order)) + list(place_years.map(year_order)),
+    })
+    order = keys.sort_values(["icb", "place", "year"], kind="stable").index
+    df = pd.concat([icb_rows, place_rows], ignore_index=True)
+    df = round_results(df.loc[order].reset_index(drop=True), index_numerator, index_names)
+
+    # Year-on-year change in each (rounded) index, within each ICB and place
+    keys = keys.loc[order].reset_index(drop=True)
+    changes = df[index_names].groupby([keys["icb"], keys["place"]], sort=False).diff()
+    for name in index_names:
+        df[f"{name} change"] = excel_round_array(changes[name], 0.001)
+    return df
@@ -0,0 +1,165 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Pluggable cache backend for the compute functions.
+The tool plugs in Streamlit's st.cache_data with set_cache_backend; everywhere else (tests, batch.py) a bounded
+in-process LRU cache is used, so the compute package never needs to import Streamlit.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import functools
+import threading
+from collections import OrderedDict
+
+
+# Maximum number of results held for each function by the default in-process cache
+DEFAULT_MAXSIZE = 32
+
+
+def lru_backend(func, maxsize=DEFAULT_MAXSIZE):
+    """
+    The default cache backend: caches the results of func in memory, keeping the maxsize most recently used.
+    Calls with arguments that can't be hashed (e.g. a DataFrame) are passed straight through without caching.
+
+    Parameters:
+    func: The function to cache.
+    maxsize: The maximum number of results to hold.
+
+    Returns:
+    The cached function, with a cache_clear method
+    """
+    results = OrderedDict()
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return func(*args, **kwargs)
+        with lock:
+            if key in results:
+                results.move_to_end(key)
+                return results[key]
+        value = func(*args, **kwargs)
+        with lock:
+            results[key] = value
+            while len(results) > maxsize:
+                results.popitem(last=False)
+        return value
+
+    def cache_clear():
+        with lock:
+            results.clear()
+
+    wrapper.cache_clear = cache_clear
+    return wrapper
+
+
+_backend = lru_backend
+
+
+def set_cache_backend(backend):
+    """
+    Sets the cache backend used by every function decorated with cached.
+
+    Parameters:
+    backend: A decorator that takes a function and returns a cached version of it, e.g. st.cache_data.  None restores the default in-process LRU cache.
+    """
+    global _backend
+    _backend = backend or lru_backend
+
+
+def get_cache_backend():
+    """Returns the cache backend currently in use."""
+    return _backend
+
+
+def cached(func):
+    """
+    Decorator that caches func with the current cache backend (see set_cache_backend).
+    The backend is applied when the function is first called, so the backend can be set after the function has been imported.
+    """
+    backends = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        backend = _backend
+        cached_func = backends.get(backend)
+        if cached_func is None:
+            cached_func = backends[backend] = backend(func)
+        return cached_func(*args, **kwargs)
+
+    return wrapper
+
+
+class ResultCache:
+    """
+    Process-wide, size-bounded cache of calculated results, shared by every session of the tool (and every session file in a batch worker).
+    Holds at most maxsize entries, dropping the least recently used first, and counts hits and misses so its use can be monitored.
+    Unlike st.cache_data, values are returned as stored rather than copied, so they must not be changed by the caller.
+    Safe to share between Streamlit sessions, which run on separate threads.
+
+    Parameters:
+    maxsize: The maximum number of entries to hold.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for key, marking it as recently used, or default if there isn't one.
+
+        Parameters:
+        key: A hashable key for the result.
+        default: The value to return if key isn't cached.
+
+        Returns:
+        The cached value, or default
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            # Drops the least recently used entries once more than maxsize are held
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """Drops every entry and resets the hit and miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the number of hits, misses and entries held, and the maximum number of entries, as a dictionary."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "maxsize": self.maxsize}
@@ -0,0 +1,441 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Loading the yearly datasets: reading the CSVs, the columnar cache next to them, the lazy registry of years,
+and the per-year practice index.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+# pyarrow is only imported when the data cache is read or written
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from compute.caching import cached
+from compute.profiling import timed
+
+
+# Version of the on-disk data cache.  Bump this whenever read_data changes the frame it builds, so old cache files are rebuilt
+DATA_CACHE_VERSION = "2"
+
+# Folder, next to the CSVs, that holds the columnar copy of each dataset
+DATA_CACHE_FOLDER = ".cache"
+
+# Geographic columns, which repeat the same few hundred values across every practice, so are held as categoricals
+GEOGRAPHY_COLUMNS = [
+    "CCG code",
+    "CCG name",
+    "PCN code",
+    "PCN name",
+    "Location code",
+    "Location name",
+    "ICB code",
+    "ICB name",
+    "Region code",
+    "Region name",
+    "LA District code",
+    "LA District name",
+    "LA code",
+    "LA name",
+]
+
+# Population and weighted population columns, which are held as population_dtype (see read_data)
+POPULATION_COLUMNS = [
+    "Registered Patients",
+    "GP pop",
+    "Weighted G&A pop",
+    "Weighted Community pop",
+    "Weighted Mental Health pop",
+    "Weighted Maternity pop",
+    "Weighted Health Inequalities pop",
+    "Weighted Prescribing pop",
+    "Overall Weighted pop",
+    "Weighted Primary Medical Care Need",
+    "Weighted Primary Care",
+]
+
+
+def read_data(path, population_dtype="float64"):
+    """
+    Reads the CSV at the provided location into a dataframe.
+    Specified columns are renamed as below and nulls in the numeric columns are replaced with zeroes.
+    Geographic columns and practice_display are held as categoricals, with blanks left as missing values.
+
+    Parameters:
+    path: The location of the CSV to be loaded.
+    population_dtype: The dtype of the population columns, "float64" (the default) or "float32" to halve their memory use.
+
+    Returns:
+    df: The data frame containing the CSV data, with columns renamed
+    """
+    # Creates a dataframe using the csv found at the location the function is called on
+    df = pd.read_csv(path)
+    # Renames the columns as below
+    df = df.rename(
+        columns={
+            "Practice_Code": "GP Practice code",
+            "GP_Practice_Name": "GP Practice name",
+            "Practice_Postcode": "GP Practice postcode",
+            "CCG": "CCG code",
+            "Former CCG": "CCG name",
+            "PCN_Code": "PCN code",
+            "PCN_Name": "PCN name",
+            "LOC": "Location code",
+            "LOCname": "Location name",
+            "ICB": "ICB code",
+            "ICBname": "ICB name",
+            "RCode": "Region code",
+            "Rcode": "Region code",
+            "Region": "Region name",
+            "LAD": "LA District code",
+            "LTLA": "LA District name",
+            "LA": "LA code",
+            "UTLA": "LA name",
+            "Patients": "Registered Patients",
+            "Population": "GP pop",
+            "G&A WP": "Weighted G&A pop",
+            "CS WP": "Weighted Community pop",
+            "MH WP": "Weighted Mental Health pop",
+            "Mat WP": "Weighted Maternity pop",
+            "Health Ineq WP": "Weighted Health Inequalities pop",
+            "Prescr WP": "Weighted Prescribing pop",
+            "Final WP": "Overall Weighted pop",
+            "Primary Medical Care WP": "Weighted Primary Medical Care Need",
+            "Final PMC WP": "Weighted Primary Care",
+        }
+    )
+    # Replaces any NA values in the numeric columns with zeroes; blank text columns are left missing rather than becoming a mix of strings and 0
+    numeric = [column for column in df.columns if column not in GEOGRAPHY_COLUMNS and pd.api.types.is_numeric_dtype(df[column])]
+    df[numeric] = df[numeric].fillna(0)
+    population = [column for column in POPULATION_COLUMNS if column in df.columns]
+    df[population] = df[population].astype(population_dtype)
+    geography = [column for column in GEOGRAPHY_COLUMNS if column in df.columns]
+    df[geography] = df[geography].astype("category")
+    # Creates a 'practice_display' column by combining the practice code and name into a single field.
+    df["practice_display"] = (df["GP Practice code"] + ": " + df["GP Practice name"]).astype("category")
+    return df
+
+
+def get_data_cache_path(path, suffix=""):
+    """
+    Returns the location of the columnar cache file for a CSV, e.g. data/.cache/2025_2026.feather for data/2025_2026.csv.
+    A suffix gives the location of another table cached for the CSV, e.g. data/.cache/2025_2026.rollup.feather for suffix ".rollup".
+    """
+    folder, filename = os.path.split(path)
+    return os.path.join(folder, DATA_CACHE_FOLDER, os.path.splitext(filename)[0] + suffix + ".feather")
+
+
+def get_file_hash(path):
+    """
+    Returns the SHA-256 hash of the file at the provided location, as a hex string.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def read_cached_data(path, population_dtype="float64"):
+    """
+    Loads the dataset for a CSV from its columnar cache file, building the cache file first if it is missing or out of date.
+    The cache file is an uncompressed Feather (Arrow IPC) file holding the frame exactly as read_data builds it, so it can be memory-mapped rather than parsed.
+    See read_cached_frame for how the cache file is checked against the CSV.
+
+    Parameters:
+    path: The location of the CSV to be loaded.
+    population_dtype: The dtype of the population columns, see read_data.  The cache file is rebuilt if it was written with a different dtype.
+
+    Returns:
+    df: The data frame containing the CSV data, with columns renamed
+    """
+    return read_cached_frame(
+        path,
+        get_data_cache_path(path),
+        {"version": DATA_CACHE_VERSION, "population_dtype": population_dtype},
+        lambda: read_data(path, population_dtype),
+    )
+
+
+@timed
+def read_cached_frame(path, cache_path, settings, build):
+    """
+    Loads a frame built from a CSV from a Feather cache file, building it and writing the cache file first if the file is missing or out of date.
+    The cache file records the settings it was built with and the CSV's size, modification time and SHA-256 hash: a matching size and
+    modification time is trusted straight away, otherwise the hash is checked so that a copied or touched but unchanged CSV doesn't force a rebuild.
+    If the cache can't be read or written (e.g. a read-only file system, or a column Arrow can't store) the frame is built directly.
+
+    Parameters:
+    path: The location of the CSV the frame is built from.
+    cache_path: The location of the cache file.
+    settings: A dictionary of strings that must match for the cache file to be used, e.g. the version of the code that builds the frame.
+    build: A function taking no arguments that builds the frame.
+
+    Returns:
+    df: The frame, with a default index
+    """
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    stat = os.stat(path)
+    source = {
+        **settings,
+        "size": str(stat.st_size),
+        "mtime_ns": str(stat.st_mtime_ns),
+    }
+
+    try:
+        with pa.memory_map(cache_path) as source_file:
+            metadata = pa.ipc.open_file(source_file).schema.metadata or {}
+        cached = {key.decode(): value.decode() for key, value in metadata.items() if key.startswith(b"source_")}
+    except (OSError, pa.ArrowInvalid):
+        cached = {}
+
+    file_hash = None
+    if cached and all(cached.get("source_" + key) == value for key, value in source.items()):
+        fresh = True
+    elif all(cached.get("source_" + key) == source[key] for key in list(settings) + ["size"]):
+        file_hash = get_file_hash(path)
+        fresh = cached.get("source_sha256") == file_hash
+    else:
+        fresh = False
+
+    if fresh:
+        try:
+            return feather.read_table(cache_path, memory_map=True).to_pandas()
+        except (OSError, pa.ArrowInvalid):
+            pass
+
+    df = build()
+    source["sha256"] = file_hash or get_file_hash(path)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            **{("source_" + key).encode(): value.encode() for key, value in source.items()},
+        })
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Writes to a temporary file first so that other processes never see a half-written cache file
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        feather.write_feather(table, temp_path, compression="uncompressed")
+        os.replace(temp_path, cache_path)
+    except (OSError, pa.ArrowException) as e:
+        print(f"Could not write data cache {cache_path}: {e}")
+    return df
+
+
+# Load data and cache
+# Uses the cache backend (st.cache_data when run in the tool, see compute.caching) to cache this operation so the data doesn't have to be read in everytime script is re-run
+@cached
+# Defines the get_data function
+def get_data(path, population_dtype="float64"):
+    """
+    Loads data from a csv at the provided location and stores it in a dataframe, using the columnar cache file next to the csv where it is up to date.
+    Specified columns are renamed and nulls are replaced with zeroes, see read_data.
+    Prints 'cache miss' to the terminal before loading, to identify that this function is actually running, vs just pulling from cache.
+    
+    Parameters:
+    path: The location of the CSV to be loaded.
+    population_dtype: The dtype of the population columns, see read_data.
+    
+    Returns:
+    df: The data frame containing the CSV data, with columns renamed
+    """
+    print('cache miss')
+    return read_cached_data(path, population_dtype)
+
+
+class DatasetRegistry:
+    """
+    Lazily loads the yearly datasets held as CSVs in a data folder.
+    A year is only read (through read_cached_data) the first time it is asked for, and at most max_loaded years are kept in memory,
+    with the least recently used year dropped first.  A year is re-read if its CSV changes on disk.
+    The registry is safe to share between Streamlit sessions, which run on separate threads.
+
+    Parameters:
+    folder: The folder containing the yearly CSVs, e.g. 'data/'.
+    max_loaded: The maximum number of years to hold in memory at once.
+    population_dtype: The dtype of the population columns, see read_data.
+    """
+
+    def __init__(self, folder, max_loaded=3, population_dtype="float64"):
+        self.folder = folder
+        self.max_loaded = max_loaded
+        self.population_dtype = population_dtype
+        self._loaded = OrderedDict()
+        self._lock = threading.RLock()
+
+    @property
+    def years(self):
+        """The years available in the data folder (the CSV filenames without ".csv"), in the order they are listed."""
+        return [filename[:-len(".csv")] for filename in os.listdir(self.folder) if filename.endswith(".csv")]
+
+    def path(self, year):
+        """Returns the location of the CSV for a year."""
+        return os.path.join(self.folder, year + ".csv")
+
+    def get(self, year):
+        """
+        Returns the dataset for a year, loading it if it isn't already held in memory.
+
+        Parameters:
+        year: The year to load, as listed in years, e.g. '2025_2026'.
+
+        Returns:
+        df: The data frame for the year, as returned by get_data
+        """
+        return self._entry(year)["data"]
+
+    def _entry(self, year):
+        # Returns the held entry for a year ({"version", "data", "derived"}), loading it first if it is missing or out of date
+        version = self.version(year)
+        with self._lock:
+            entry = self._loaded.get(year)
+            if entry is None or entry["version"] != version:
+                entry = {"version": version, "data": read_cached_data(self.path(year), self.population_dtype), "derived": {}}
+                self._loaded[year] = entry
+            self._loaded.move_to_end(year)
+            # Drops the least recently used years once more than max_loaded are held
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+            return entry
+
+    def derive(self, year, name, builder):
+        """
+        Returns a table or index derived from a year's dataset, building it the first time it is asked for.
+        Derived items are held with the dataset, so they are rebuilt when the year is re-read and dropped when it is dropped.
+
+        Parameters:
+        year: The year the item is derived from, e.g. '2025_2026'.
+        name: A name for the derived item, unique for each builder.
+        builder: A function taking the year's data frame and returning the derived item.
+
+        Returns:
+        The derived item
+        """
+        # The entry is looked up and its item built under one lock, from the entry's own data, so another session can't drop or
+        # re-read the year in between and leave an item built from an old copy of the data attached to the new one
+        with self._lock:
+            entry = self._entry(year)
+            derived = entry["derived"]
+            if name not in derived:
+                derived[name] = builder(entry["data"])
+            return derived[name]
+
+    def version(self, year):
+        """Returns the (size, modification time) of a year's CSV, which changes whenever the file does, without loading it."""
+        stat = os.stat(self.path(year))
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def loaded_years(self):
+        """The years currently held in memory, from least to most recently used."""
+        with self._lock:
+            return list(self._loaded)
+
+
+@timed
+def build_practice_index(data):
+    """
+    Builds a lookup from each practice to its row in a year's data, with the practice coordinates held in arrays.
+    Used to find the practices in a place without scanning the whole dataset for each one.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+
+    Returns:
+    practice_index: A dictionary containing
+        "display": practice_display value -> row position
+        "code": GP Practice code -> row position
+        "latitude", "longitude": numpy arrays of the coordinates, by row position
+    """
+    positions = range(len(data))
+    return {
+        "display": dict(zip(data["practice_display"], positions)),
+        "code": dict(zip(data["GP Practice code"], positions)),
+        "latitude": data["Latitude"].to_numpy(dtype=float),
+        "longitude": data["Longitude"].to_numpy(dtype=float),
+    }
+
+
+@timed
+def build_selection_index(data):
+    """
+    Builds the lists the sidebar offers when creating a place, for every ICB and LA District at once, so each rerun of the tool
+    only has to look its lists up rather than filter the whole dataset.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+
+    Returns:
+    selection_index: A dictionary containing
+        "icbs": the ICB names, sorted
+        "lads": ICB name -> {LA District name -> sorted list of practice_display values}, with the LA Districts in the order they appear in the data
+        "practices": ICB name -> sorted list of the practice_display values of every practice in the ICB
+    """
+    frame = pd.DataFrame({
+        "icb": data["ICB name"],
+        "lad": data["LA District name"],
+        "practice": data["practice_display"].astype(object),
+    })
+    selection_index = {"icbs": [], "lads": {}, "practices": {}}
+    for icb, icb_rows in frame.groupby("icb", sort=True, observed=True):
+        selection_index["icbs"].append(icb)
+        selection_index["practices"][icb] = sorted(icb_rows["practice"].unique().tolist())
+        selection_index["lads"][icb] = {
+            lad: sorted(lad_rows["practice"].unique().tolist())
+            for lad, lad_rows in icb_rows.groupby("lad", sort=False, observed=True)
+        }
+    return selection_index
+
+
+def select_practices(selection_index, icb, lads=None):
+    """
+    Looks up the practices the sidebar offers for an ICB, optionally narrowed to some of its LA Districts.
+
+    Parameters:
+    selection_index: The selection index for the year, see build_selection_index.
+    icb: The name of the selected ICB.
+    lads: The names of the selected LA Districts; if empty or None, every practice in the ICB is returned.
+
+    Returns:
+    practices: A sorted list of practice_display values
+    """
+    if not lads:
+        return selection_index["practices"].get(icb, [])
+    icb_lads = selection_index["lads"].get(icb, {})
+    return sorted(practice for lad in lads for practice in icb_lads.get(lad, []))
+
+
+def find_practices(practice_index, gps, key="display"):
+    """
+    Looks up a list of practices in a practice index built by build_practice_index.
+
+    Parameters:
+    practice_index: The practice index for the year.
+    gps: The practices to find, as practice_display values (or practice codes if key is "code").
+    key: Either "display" or "code", the field the practices are given as.
+
+    Returns:
+    found: A list of the practices that are in the data, in the order given
+    positions: A numpy array with the row position of each practice in found
+    missing: A list of the practices that are not in the data for the year
+    """
+    lookup = practice_index[key]
+    found, positions, missing = [], [], []
+    for gp in gps:
+        position = lookup.get(gp)
+        if position is None:
+            missing.append(gp)
+        else:
+            found.append(gp)
+            positions.append(position)
+    return found, np.array(positions, dtype=int), missing
@@ -0,0 +1,172 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Lightweight timing of the stages of a rerun of the tool and of the compute functions they call.
+A profiler is only active for a rerun when it is switched on (see start_profiler); otherwise span, timed and stage do
+nothing beyond looking up the active profiler, so the instrumentation can stay in place at no real cost.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import contextlib
+import contextvars
+import functools
+import json
+import time
+
+
+# The profiler of the current rerun, or None.  Streamlit runs each session's script on its own thread, so each session sees its own
+_active = contextvars.ContextVar("profiler", default=None)
+
+# Context manager used in place of a span when no profiler is active
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Records how long each stage of a rerun, and each timed function called within it, takes.
+    Stages follow one another (see stage); spans are nested within the current stage and within each other.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._path = []
+        self._stage = None
+        self._start = time.perf_counter()
+        self.total = None
+
+    def stage(self, name):
+        """Ends the current stage, if there is one, and starts the stage called name."""
+        self._end_stage()
+        self._stage = (name, time.perf_counter(), len(self.spans))
+        # Reserves the stage's place ahead of the spans within it
+        self.spans.append(None)
+        self._path = [name]
+
+    def _end_stage(self):
+        if self._stage is not None:
+            name, start, position = self._stage
+            self.spans[position] = {"name": name, "path": name, "depth": 0, "seconds": time.perf_counter() - start}
+            self._stage = None
+            self._path = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Context manager that records the time taken by the code within it, as a span called name."""
+        position = len(self.spans)
+        self.spans.append(None)
+        self._path.append(name)
+        path = " / ".join(self._path)
+        depth = len(self._path) - 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[position] = {"name": name, "path": path, "depth": depth, "seconds": time.perf_counter() - start}
+            self._path.pop()
+
+    def stop(self):
+        """Ends the current stage and the rerun, returning the total time taken in seconds."""
+        self._end_stage()
+        self.total = time.perf_counter() - self._start
+        if _active.get() is self:
+            _active.set(None)
+        return self.total
+
+    def records(self):
+        """Returns the finished spans, in the order they started, as a list of {"name", "path", "depth", "seconds"} dictionaries."""
+        return [span for span in self.spans if span is not None]
+
+    def to_json(self):
+        """Returns the spans and the total time of the rerun as a JSON string."""
+        return json.dumps({"total_seconds": self.total, "spans": self.records()}, indent=4)
+
+    def to_prometheus(self, prefix="icb_tool"):
+        """
+        Returns the time and number of calls of each span, summed by path, in the Prometheus text exposition format.
+
+        Parameters:
+        prefix: The prefix of the metric names.
+
+        Returns:
+        text: The metrics, one sample per line
+        """
+        totals = {}
+        for span in self.records():
+            seconds, count = totals.get(span["path"], (0.0, 0))
+            totals[span["path"]] = (seconds + span["seconds"], count + 1)
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent in each stage and timed function of the last profiled rerun.",
+            f"# TYPE {prefix}_span_seconds gauge",
+        ]
+        lines += [f'{prefix}_span_seconds{{span="{_escape(path)}"}} {seconds:.6f}' for path, (seconds, _) in totals.items()]
+        lines += [
+            f"# HELP {prefix}_span_calls Number of times each stage and timed function ran in the last profiled rerun.",
+            f"# TYPE {prefix}_span_calls gauge",
+        ]
+        lines += [f'{prefix}_span_calls{{span="{_escape(path)}"}} {count}' for path, (_, count) in totals.items()]
+        if self.total is not None:
+            lines += [
+                f"# HELP {prefix}_rerun_seconds Total time of the last profiled rerun.",
+                f"# TYPE {prefix}_rerun_seconds gauge",
+                f"{prefix}_rerun_seconds {self.total:.6f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    # Label values escape backslashes, double quotes and newlines
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_profiler(enabled=True):
+    """
+    Starts profiling the current rerun (or script), replacing any profiler left from an earlier one.
+
+    Parameters:
+    enabled: Whether to profile.  If False, profiling is switched off and span, timed and stage do nothing.
+
+    Returns:
+    profiler: The new Profiler, or None if not enabled
+    """
+    profiler = Profiler() if enabled else None
+    _active.set(profiler)
+    return profiler
+
+
+def get_profiler():
+    """Returns the active profiler, or None if profiling is switched off."""
+    return _active.get()
+
+
+def span(name):
+    """Context manager that records the code within it as a span called name, if a profiler is active."""
+    profiler = _active.get()
+    if profiler is None:
+        return _NO_SPAN
+    return profiler.span(name)
+
+
+def stage(name):
+    """Ends the current stage of the rerun and starts the stage called name, if a profiler is active."""
+    profiler = _active.get()
+    if profiler is not None:
+        profiler.stage(name)
+
+
+def timed(func):
+    """Decorator that records each call of func as a span named after the function, if a profiler is active."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active.get()
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.span(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,139 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+The rollup cube: weighted populations and need indices for every standard geography (practice, PCN, LA District, ICB, Region and England),
+built once per year and cached next to the data.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import pandas as pd
+
+from compute.aggregation import (
+    AGGREGATIONS,
+    INDEX_NUMERATOR,
+    INDEX_NAMES,
+    aggregate_places,
+    build_membership,
+    get_icb_index,
+    round_results,
+)
+from compute.loading import DATA_CACHE_VERSION, get_data_cache_path, read_cached_frame
+from compute.profiling import timed
+
+
+# Version of the cached rollup cube.  Bump this whenever build_rollup changes the table it builds
+ROLLUP_CACHE_VERSION = "1"
+
+# Levels of the cube, from smallest to largest, with the columns holding the code and name of each area.  England has no column, as it is the whole dataset
+ROLLUP_LEVELS = {
+    "Practice": ("GP Practice code", "practice_display"),
+    "PCN": ("PCN code", "PCN name"),
+    "LA District": ("LA District code", "LA District name"),
+    "ICB": ("ICB code", "ICB name"),
+    "Region": ("Region code", "Region name"),
+    "England": (None, None),
+}
+
+
+@timed
+def build_rollup(data, aggregations=AGGREGATIONS, index_numerator=INDEX_NUMERATOR, index_names=INDEX_NAMES):
+    """
+    Builds the rollup cube for a year: the summed weighted populations and need indices of every area at every level of ROLLUP_LEVELS.
+    Indices are calculated in the same way as the ICB index ([index_numerator] / [GP pop]); the weighted populations in the data are scaled so
+    that England's are equal to its GP population, so these are relative to national need.
+    Levels the data has no codes for (e.g. PCN, when the PCN columns are blank) have no rows.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    aggregations: The library of column names and the aggregation functions to be performed on them.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the indexes to be created.
+
+    Returns:
+    cube: A df with "Level", "Code" and "Name" columns followed by the aggregated columns and the indices, unrounded
+    """
+    frames = []
+    for level, (code_column, name_column) in ROLLUP_LEVELS.items():
+        if code_column is None:
+            level_data = data.assign(Code="ENG", Name="England")
+        elif code_column in data.columns:
+            # Areas without a name column are named by their code
+            level_data = data.assign(Code=data[code_column], Name=data[name_column] if name_column in data.columns else data[code_column])
+        else:
+            continue
+        # observed=True leaves out the codes of a categorical that aren't used; rows with a blank code are dropped by the groupby
+        grouped = level_data.groupby("Code", sort=True, observed=True).agg({"Name": "first", **aggregations})
+        grouped.index = grouped.index.astype(str)
+        grouped["Name"] = grouped["Name"].astype(object)
+        frames.append(grouped.reset_index().assign(Level=level))
+    cube = pd.concat(frames, ignore_index=True)
+    cube = get_icb_index(cube, index_names, index_numerator)
+    return cube[["Level", "Code", "Name"] + [column for column in cube.columns if column not in ("Level", "Code", "Name")]]
+
+
+def read_cached_rollup(path, data):
+    """
+    Loads the rollup cube for a year from its cache file next to the data cache (e.g. data/.cache/2025_2026.rollup.feather),
+    building it with build_rollup and writing the cache file first if it is missing or out of date.
+
+    Parameters:
+    path: The location of the year's CSV.
+    data: The practice-level data for the year, as returned by get_data for path.
+
+    Returns:
+    cube: The rollup cube, see build_rollup
+    """
+    population_dtype = str(data["GP pop"].dtype)
+    return read_cached_frame(
+        path,
+        get_data_cache_path(path, ".rollup"),
+        {"version": ROLLUP_CACHE_VERSION, "data_version": DATA_CACHE_VERSION, "population_dtype": population_dtype},
+        lambda: build_rollup(data),
+    )
+
+
+def get_rollup_level(cube, level, index_numerator=INDEX_NUMERATOR, index_names=INDEX_NAMES):
+    """
+    Returns the rows of the rollup cube for one level, e.g. every LA District, rounded in the same way as the tool's download.
+
+    Parameters:
+    cube: The rollup cube, see build_rollup.
+    level: One of the keys of ROLLUP_LEVELS.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the index columns.
+
+    Returns:
+    df: The rows for the level, without the "Level" column
+    """
+    df = cube.loc[cube["Level"] == level].drop(columns="Level").reset_index(drop=True)
+    return round_results(df, index_numerator, index_names)
+
+
+def get_national_place_indices(data, session_state, cube, aggregations=AGGREGATIONS, index_numerator=INDEX_NUMERATOR, index_names=INDEX_NAMES):
+    """
+    Calculates the need indices of the places in the session relative to England, rather than to their ICB.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    session_state: The session state (or a dict with the same layout), containing the "places" list and a {"gps": [...], "icb": ...} entry for each place.
+    cube: The rollup cube for the same year, see build_rollup.
+    aggregations: The library of column names and the aggregation functions to be performed on them.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the indexes to be created.
+
+    Returns:
+    df: A df with a "Place Name" column followed by the aggregated columns and the national-relative indices, rounded, in session order
+    """
+    place_groupby = aggregate_places(data, build_membership(session_state), aggregations)
+    england = cube.loc[cube["Level"] == "England", index_names].to_numpy()
+    place_groupby[index_names] = (
+        place_groupby[index_numerator].div(place_groupby["GP pop"].values, axis=0).div(england[0], axis=1).values
+    )
+    places = [place for place in session_state["places"] if place in place_groupby.index]
+    df = place_groupby.loc[places].reset_index()
+    return round_results(df, index_numerator, index_names)
@@ -0,0 +1,82 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Excel-style "round half up" rounding, for single values and whole arrays.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+
+import numpy as np
+
+
+def excel_round(number, precision=0.01) -> float:
+    """
+    Rounds a number to a specified precision using the "round half up" method, similar to Excel.
+
+    Parameters:
+    number (float/int): The number to be rounded.
+    precision (float/int): The precision to round to (e.g., 0.1, 0.01, 100, etc.).
+
+    Returns:
+    float: The rounded number, or the original value if it's not numeric.
+    """
+    try:
+        if isinstance(number, (int, float)):  # Ensure the number is numeric
+            if precision > 1:  # For rounding to nearest ten, hundreds, etc.
+                rounded_num = round(number / precision) * precision
+            else:  # For decimal precision
+                number = Decimal(str(number))
+                precision = Decimal(str(precision))
+                rounded_num = number.quantize(precision, rounding=ROUND_HALF_UP)
+            return float(rounded_num)
+        else:
+            return number  # Return the value unchanged if it's not numeric
+    except (ValueError, InvalidOperation):
+        return number  # Return the value unchanged if there's an error during conversion
+
+def excel_round_array(values, precision=0.01):
+    """
+    Rounds a whole array of numbers to a specified precision using the "round half up" method, similar to Excel.
+    Gives exactly the same results as calling excel_round on every value, without building a Decimal for each one.
+
+    excel_round rounds the shortest decimal form of each number (Decimal(str(x))).  Here each value is instead compared with
+    the half-way points either side of it, each built with a single correctly rounded division.  A value is at or above a
+    half-way point exactly when its shortest decimal form is, so the comparison gives the same answer without any strings.
+    Values too large for this to hold (more than 2**48 once scaled) are passed to excel_round one at a time.
+
+    Parameters:
+    values (array-like): The numbers to be rounded, e.g. a list, Series or the values of a DataFrame.
+    precision (float/int): The precision to round to (e.g., 0.1, 0.01, 100, etc.).
+
+    Returns:
+    numpy.ndarray: A float array with the same shape as values, containing the rounded numbers.
+    """
+    values = np.asarray(values, dtype=float)
+    if precision > 1:  # For rounding to nearest ten, hundreds, etc.
+        # Matches round(), which rounds halves to the nearest even number and returns an integer, so never gives -0.0
+        return np.round(values / precision) * precision + 0.0
+
+    # Decimal.quantize rounds to the number of decimal places in the precision, e.g. 3 for 0.001
+    places = -Decimal(str(precision)).as_tuple().exponent
+    scale = 10.0 ** places
+    magnitude = np.abs(values)
+    with np.errstate(invalid="ignore", over="ignore"):
+        scaled = magnitude * scale
+        lower = np.floor(scaled)
+        # lower is within one of the true rounded-down value, so counting how many of the three
+        # nearest half-way points the value has reached gives the rounded-up value
+        rounded = lower - 1
+        for offset in (-0.5, 0.5, 1.5):
+            rounded += magnitude >= (lower + offset) / scale
+        result = np.copysign(rounded / scale, values)
+
+    fallback = ~(scaled < 2 ** 48) & ~np.isnan(values) if places <= 22 else ~np.isnan(values)
+    if fallback.any():
+        result[fallback] = [excel_round(float(number), precision) for number in values[fallback]]
+    return result
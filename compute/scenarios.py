@@ -0,0 +1,193 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Comparing alternative place designs for an ICB: every place of every design is aggregated in a single pass,
+and the designs are ranked by how much need varies between their places.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+
+from compute.aggregation import (
+    AGGREGATIONS,
+    INDEX_NUMERATOR,
+    INDEX_NAMES,
+    aggregate_places,
+    build_icb_table,
+    get_place_index,
+    round_results,
+)
+from compute.profiling import timed
+from compute.rounding import excel_round_array
+
+
+# Columns of the data that an ICB can be split into places by, used as the built-in designs
+GROUPING_COLUMNS = ["LA District name", "PCN code", "Location name"]
+
+
+def build_grouping_membership(data, icb, columns=GROUPING_COLUMNS):
+    """
+    Builds the membership table of the designs made by splitting an ICB's practices on each of the given columns,
+    e.g. one place per LA District.  Practices with a blank value in a column are left out of that design.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    icb: The name of the ICB to split.
+    columns: The columns to split the ICB on, one design per column.
+
+    Returns:
+    membership: A df with "Design", "Place Name" and "practice_display" columns
+    """
+    icb_data = data.loc[data["ICB name"] == icb]
+    frames = []
+    for column in columns:
+        rows = icb_data[[column, "practice_display"]].dropna()
+        frames.append(pd.DataFrame({
+            "Design": column,
+            "Place Name": rows[column].astype(str).to_numpy(),
+            "practice_display": rows["practice_display"].astype(str).to_numpy(),
+        }))
+    return pd.concat(frames, ignore_index=True) if frames else _empty_membership()
+
+
+def build_design_membership(designs):
+    """
+    Builds the membership table of user-supplied designs.
+
+    Parameters:
+    designs: A dictionary of design name -> {place name -> list of practice_display values}, i.e. the "places" of each
+             design in the same form as a session file without the "places" list and ICB.
+
+    Returns:
+    membership: A df with "Design", "Place Name" and "practice_display" columns, with duplicate practices within a place dropped
+    """
+    rows = [
+        (design, place, gp)
+        for design, places in designs.items()
+        for place, gps in places.items()
+        for gp in gps
+    ]
+    if not rows:
+        return _empty_membership()
+    membership = pd.DataFrame(rows, columns=["Design", "Place Name", "practice_display"])
+    return membership.drop_duplicates(ignore_index=True)
+
+
+def _empty_membership():
+    return pd.DataFrame({"Design": [], "Place Name": [], "practice_display": []}, dtype=object)
+
+
+@timed
+def evaluate_designs(
+    data,
+    icb,
+    membership,
+    icb_table=None,
+    aggregations=AGGREGATIONS,
+    index_numerator=INDEX_NUMERATOR,
+    index_names=INDEX_NAMES,
+    rounded=True,
+):
+    """
+    Calculates the weighted populations and need indices of every place in every design, relative to the ICB.
+    All the places of all the designs are aggregated together in one pass (see aggregate_places), so evaluating
+    many designs costs little more than evaluating one.
+
+    Parameters:
+    data: The practice-level data for a single year, as returned by get_data.
+    icb: The name of the ICB the designs split, whose index the place indices are relative to.
+    membership: The membership table of the designs, from build_grouping_membership and/or build_design_membership.
+    icb_table: The precomputed ICB table for the year (see build_icb_table); built from data if not given.
+    aggregations: The library of column names and the aggregation functions to be performed on them.
+    index_numerator: List of column names that contain the numerator values for the index calculation.
+    index_names: List of the indexes to be created.
+    rounded: Whether to round the results in the same way as the tool's download (see round_results).  Pass False to compare
+             the designs on the unrounded figures with compare_designs, then round the results for display.
+
+    Returns:
+    results: A df with one row per place, with "Design", "Place Name" and "Practices" columns followed by the columns of the tool's
+             download.  Places with none of their practices in the data are left out.
+    """
+    if icb_table is None:
+        icb_table = build_icb_table(data.loc[data["ICB name"] == icb], aggregations, index_numerator, index_names)
+
+    # Numbers each (design, place) pair, in the order they first appear, so places with the same name in different designs are kept apart
+    place_ids = membership.groupby(["Design", "Place Name"], sort=False).ngroup().to_numpy()
+    labels = membership[["Design", "Place Name"]].drop_duplicates(ignore_index=True)
+    place_membership = pd.DataFrame({"Place Name": place_ids, "practice_display": membership["practice_display"].to_numpy()})
+    place_groupby = aggregate_places(data, place_membership, aggregations)
+
+    results = get_place_index(
+        place_groupby, icb_table, index_names, index_numerator, place_icbs=[icb] * len(place_groupby)
+    )
+    results = results.reset_index(drop=True)
+    if rounded:
+        results = round_results(results, index_numerator, index_names)
+
+    # Counts the practices of each place that were found in the data
+    found = place_ids[place_membership["practice_display"].isin(data["practice_display"]).to_numpy()]
+    counts = np.bincount(found, minlength=len(labels))
+    ids = place_groupby.index.to_numpy(dtype=np.intp)
+    results.insert(loc=0, column="Practices", value=counts[ids])
+    results.insert(loc=0, column="Place Name", value=labels["Place Name"].to_numpy()[ids])
+    results.insert(loc=0, column="Design", value=labels["Design"].to_numpy()[ids])
+    return results
+
+
+def compare_designs(results, data, icb, index_name="Overall Core Index"):
+    """
+    Summarises each design evaluated by evaluate_designs, ranked by how much the chosen need index varies between its places.
+    The spread is the GP population weighted standard deviation of the place indices, so a design whose places
+    differ more in need is ranked higher.  The figures are calculated from the results as given and rounded at the end, in the
+    same way as Excel would, so pass the unrounded results (evaluate_designs with rounded=False) for the spread to be exact.
+
+    Parameters:
+    results: The place results returned by evaluate_designs.
+    data: The practice-level data for the year, used to find how much of the ICB each design covers.
+    icb: The name of the ICB the designs split.
+    index_name: The need index to compare the designs on.
+
+    Returns:
+    comparison: A df with one row per design, in rank order
+    """
+    icb_pop = data.loc[data["ICB name"] == icb, "GP pop"].sum()
+    spread_name = f"{index_name} spread"
+
+    # GP population weighted mean and standard deviation of the index across each design's places, for all designs at once
+    df = pd.DataFrame({
+        "Design": results["Design"],
+        "weight": results["GP pop"].astype(float),
+        "weighted": results["GP pop"].astype(float) * results[index_name],
+        "weighted_square": results["GP pop"].astype(float) * results[index_name] ** 2,
+    })
+    sums = df.groupby("Design", sort=False).sum()
+    mean = sums["weighted"] / sums["weight"]
+    variance = (sums["weighted_square"] / sums["weight"] - mean ** 2).clip(lower=0)
+
+    groups = results.groupby("Design", sort=False)
+    comparison = pd.DataFrame({
+        "Places": groups.size(),
+        "Practices": groups["Practices"].sum(),
+        "GP pop covered (%)": 100 * sums["weight"] / icb_pop if icb_pop else np.nan,
+        "Smallest place GP pop": groups["GP pop"].min(),
+        "Largest place GP pop": groups["GP pop"].max(),
+        f"Lowest {index_name}": groups[index_name].min(),
+        f"Highest {index_name}": groups[index_name].max(),
+        spread_name: np.sqrt(variance),
+    }).reset_index()
+    comparison = comparison.sort_values(spread_name, ascending=False, kind="stable", ignore_index=True)
+    comparison.insert(loc=0, column="Rank", value=np.arange(1, len(comparison) + 1))
+
+    # Rounding the figures here, after the designs are ranked on the unrounded spread
+    populations = ["Smallest place GP pop", "Largest place GP pop"]
+    indices = [f"Lowest {index_name}", f"Highest {index_name}", spread_name]
+    comparison["GP pop covered (%)"] = excel_round_array(comparison["GP pop covered (%)"], 0.1)
+    comparison[populations] = excel_round_array(comparison[populations], 1)
+    comparison[indices] = excel_round_array(comparison[indices], 0.001)
+    return comparison
@@ -0,0 +1,296 @@
+# -------------------------------------------------------------------------
+# Copyright (c) 2021 NHS England and NHS Improvement. All rights reserved.
+# Licensed under the MIT License and the Open Government License v3. See
+# license.txt in the project root for license information.
+# -------------------------------------------------------------------------
+
+"""
+Reading and writing session files ("Download session data" in the tool) and checking them against a year's data before they are imported.
+
+Version 2 session files list each place with its ICB and the sorted codes of its practices:
+    {"version": 2, "places": [{"name": "Default Place", "icb": "NHS West Yorkshire ICB", "practices": ["B85005", ...]}, ...]}
+They can be written as JSON text, gzip-compressed JSON or (if the msgpack package is installed) MessagePack.
+Version 1 files, written before the version was recorded, hold a "places" list and an entry of {"gps": ["CODE: NAME", ...], "icb": ...}
+for each place.  Both are read, and the practices of both are matched to the data on their codes, so renamed practices are still found.
+"""
+
+# Libraries
+# -------------------------------------------------------------------------
+import gzip
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+from compute.profiling import timed
+
+
+# Version of the session files written by write_session
+SESSION_VERSION = 2
+
+# Encodings write_session can use, with the file name and MIME type of each
+SESSION_ENCODINGS = {
+    "json": ("session.json", "application/json"),
+    "gzip": ("session.json.gz", "application/gzip"),
+    "msgpack": ("session.msgpack", "application/msgpack"),
+}
+
+# Whitespace allowed between JSON tokens
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+# Columns of the validation report returned by import_session
+REPORT_COLUMNS = ["Place Name", "ICB name", "Practices", "Missing practices", "Practices in another ICB", "Status"]
+
+
+def iter_session_items(text):
+    """
+    Parses the top-level object of a session file one member at a time, yielding each (key, value) pair as soon as it is decoded.
+    Each place is decoded on its own, so a file with thousands of places never has to be held as one nested structure
+    alongside the text, and a malformed place is reported with its position.
+
+    Parameters:
+    text: The contents of the session file, as a string.
+
+    Returns:
+    A generator of (key, value) pairs, in the order they appear in the file
+    """
+    decoder = json.JSONDecoder()
+    position = _WHITESPACE.match(text, 0).end()
+    if text[position:position + 1] != "{":
+        raise ValueError("A session file must contain a JSON object")
+    position = _WHITESPACE.match(text, position + 1).end()
+    if text[position:position + 1] == "}":
+        return
+    while True:
+        key, position = decoder.raw_decode(text, position)
+        if not isinstance(key, str):
+            raise ValueError(f"Expected a name at position {position}")
+        position = _WHITESPACE.match(text, position).end()
+        if text[position:position + 1] != ":":
+            raise ValueError(f"Expected ':' at position {position}")
+        position = _WHITESPACE.match(text, position + 1).end()
+        value, position = decoder.raw_decode(text, position)
+        yield key, value
+        position = _WHITESPACE.match(text, position).end()
+        separator = text[position:position + 1]
+        position = _WHITESPACE.match(text, position + 1).end()
+        if separator == "}":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or '}}' at position {position}")
+
+
+def _practice_code(gp):
+    # practice_display values are "CODE: NAME", see read_data
+    return gp.split(": ", 1)[0]
+
+
+def match_practice_codes(codes, data):
+    """
+    Looks practice codes up in a year's data, in a single vectorised join.
+    Only the first practice with each code is matched, in case a code appears more than once.
+
+    Parameters:
+    codes: The practice codes to look up, e.g. a list or an Index.
+    data: The practice-level data for a year, as returned by get_data.
+
+    Returns:
+    positions: numpy array of the row position in data of each code, or -1 for codes that aren't in the data
+    """
+    if "GP Practice code" in data.columns:
+        data_codes = data["GP Practice code"].astype(object)
+    else:
+        data_codes = data["practice_display"].astype(str).map(_practice_code)
+    first = ~data_codes.duplicated().to_numpy()
+    positions = pd.Index(data_codes.to_numpy()[first]).get_indexer(pd.Index(codes, dtype=object))
+    return np.where(positions < 0, -1, np.flatnonzero(first)[positions])
+
+
+def write_session(session, encoding="json"):
+    """
+    Writes the places of a session as a version 2 session file.
+
+    Parameters:
+    session: The session state (or a dict with the same layout), containing the "places" list and a {"gps": [...], "icb": ...} entry for each place.
+    encoding: One of the keys of SESSION_ENCODINGS: "json" for indented JSON text, "gzip" for compact gzip-compressed JSON,
+              or "msgpack" for MessagePack, which needs the msgpack package.
+
+    Returns:
+    content: The contents of the session file, as bytes
+    """
+    content = {
+        "version": SESSION_VERSION,
+        "places": [
+            {
+                "name": place,
+                "icb": session[place]["icb"],
+                "practices": sorted(dict.fromkeys(_practice_code(gp) for gp in session[place]["gps"])),
+            }
+            for place in session["places"]
+        ],
+    }
+    if encoding == "json":
+        return json.dumps(content, indent=4).encode("utf-8")
+    if encoding == "gzip":
+        # mtime=0 keeps the file the same for the same session, so it can be hashed
+        return gzip.compress(json.dumps(content, separators=(",", ":")).encode("utf-8"), mtime=0)
+    if encoding == "msgpack":
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError("Writing MessagePack session files needs the msgpack package") from None
+        return msgpack.packb(content)
+    raise ValueError(f"Unsupported session encoding '{encoding}', use one of {', '.join(SESSION_ENCODINGS)}")
+
+
+def parse_session(content):
+    """
+    Reads the places from a session file of either version, in any of the encodings written by write_session.
+    Version 1 JSON is parsed one place at a time (see iter_session_items).
+
+    Parameters:
+    content: The contents of the session file, as bytes or a string.
+
+    Returns:
+    places: A list of (place name, entry) pairs in the order the places are listed, without repeated names, where entry is
+            {"icb": ..., "codes": [...], "gps": [...]} (the practice codes, and the practices as written in the file),
+            or None if the place has no valid practices and ICB
+    """
+    if isinstance(content, bytes):
+        if content[:2] == b"\x1f\x8b":
+            try:
+                content = gzip.decompress(content)
+            except (OSError, EOFError) as e:
+                raise ValueError(f"Could not decompress the session file: {e}") from None
+        if content.lstrip()[:1] == b"{":
+            content = content.decode("utf-8")
+        else:
+            try:
+                import msgpack
+            except ImportError:
+                raise ValueError("The session file isn't JSON; reading MessagePack session files needs the msgpack package") from None
+            try:
+                return _parse_version_2(msgpack.unpackb(content))
+            except (msgpack.UnpackException, ValueError) as e:
+                raise ValueError(f"Could not read the session file: {e}") from None
+
+    entries = {}
+    listed = None
+    version = None
+    for key, value in iter_session_items(content):
+        if key == "places":
+            listed = value
+        elif key == "version" and isinstance(value, int):
+            version = value
+        elif key not in entries:
+            entries[key] = value
+    if version is not None:
+        return _parse_version_2({"version": version, "places": listed})
+    if not isinstance(listed, list):
+        raise ValueError('A session file must contain a "places" list')
+
+    places = []
+    for place in dict.fromkeys(str(place) for place in listed):
+        entry = entries.get(place)
+        if not (isinstance(entry, dict) and isinstance(entry.get("gps"), list) and isinstance(entry.get("icb"), str)):
+            places.append((place, None))
+            continue
+        gps = list(dict.fromkeys(str(gp) for gp in entry["gps"]))
+        places.append((place, {"icb": entry["icb"], "codes": [_practice_code(gp) for gp in gps], "gps": gps}))
+    return places
+
+
+def _parse_version_2(content):
+    if not isinstance(content, dict) or not isinstance(content.get("places"), list):
+        raise ValueError('A session file must contain a "places" list')
+    if content.get("version") != SESSION_VERSION:
+        raise ValueError(f"Session files of version {content.get('version')} can't be read, the latest version is {SESSION_VERSION}")
+    places = {}
+    for item in content["places"]:
+        if not isinstance(item, dict) or "name" not in item:
+            raise ValueError("Each place in a session file must have a name")
+        place = str(item["name"])
+        if place in places:
+            continue
+        if isinstance(item.get("practices"), list) and isinstance(item.get("icb"), str):
+            codes = list(dict.fromkeys(str(code) for code in item["practices"]))
+            places[place] = {"icb": item["icb"], "codes": codes, "gps": codes}
+        else:
+            places[place] = None
+    return list(places.items())
+
+
+@timed
+def import_session(content, data):
+    """
+    Reads a session file of either version and checks every place in it against a year's data, ready to be imported into the tool in one go.
+    See parse_session and resolve_session.
+
+    Parameters:
+    content: The contents of the session file, as bytes or a string.
+    data: The practice-level data for the year to check the practices against, as returned by get_data.
+
+    Returns:
+    session: The places to import, in the layout of session_state, see resolve_session
+    report: The validation report, see resolve_session
+    """
+    return resolve_session(parse_session(content), data)
+
+
+def resolve_session(places, data):
+    """
+    Matches the practices of the places read from a session file to a year's data, on their practice codes.
+    All the practices of all the places are looked up in the data in a single vectorised join.  Places with the same
+    ICB and the same practices as an earlier place are dropped as duplicates, as are places that are listed but have no
+    valid entry.  Practices missing from the data are kept as written in the file (they may be in other years) but reported.
+
+    Parameters:
+    places: The places read from the session file, as returned by parse_session.
+    data: The practice-level data for the year to check the practices against, as returned by get_data.
+
+    Returns:
+    session: The places to import, in the layout of session_state: a "places" list and a {"gps": [...], "icb": ...} entry for each place,
+             with the practices given as the practice_display values of the year
+    report: A df with one row per place in the file (see REPORT_COLUMNS), giving the number of practices, how many are missing from the
+            data or belong to another ICB, and whether the place was imported
+    """
+    valid = [(place, entry) for place, entry in places if entry is not None]
+
+    # Looks every practice of every place up in the data at once, on the practice codes
+    place_ids = np.repeat(np.arange(len(valid)), [len(entry["codes"]) for _, entry in valid])
+    codes = pd.Index([code for _, entry in valid for code in entry["codes"]], dtype=object)
+    labels = np.array([gp for _, entry in valid for gp in entry["gps"]], dtype=object)
+    positions = match_practice_codes(codes, data)
+    missing = positions < 0
+    # Practices found in the data are given the year's practice_display, those that aren't keep the label from the file
+    labels[~missing] = data["practice_display"].astype(object).to_numpy()[positions[~missing]]
+    icbs = np.array([entry["icb"] for _, entry in valid], dtype=object)
+    other_icb = np.zeros(len(positions), dtype=bool)
+    other_icb[~missing] = data["ICB name"].astype(object).to_numpy()[positions[~missing]] != icbs[place_ids[~missing]]
+    missing_counts = np.bincount(place_ids, weights=missing, minlength=len(valid)).astype(int)
+    other_icb_counts = np.bincount(place_ids, weights=other_icb, minlength=len(valid)).astype(int)
+    bounds = np.concatenate([[0], np.cumsum([len(entry["codes"]) for _, entry in valid])]).astype(int)
+
+    session = {"places": []}
+    rows = []
+    seen = {}
+    valid_ids = {place: number for number, (place, _) in enumerate(valid)}
+    for place, entry in places:
+        if entry is None:
+            rows.append((place, None, 0, 0, 0, "Invalid: no practices and ICB found for this place"))
+            continue
+        number = valid_ids[place]
+        gps = list(dict.fromkeys(labels[bounds[number]:bounds[number + 1]].tolist()))
+        # Places are identical if they have the same ICB and the same practices, in any order
+        key = (entry["icb"], frozenset(gps))
+        if key in seen:
+            # Duplicates aren't imported, so have no counts
+            rows.append((place, entry["icb"], len(gps), 0, 0, f"Duplicate of {seen[key]}, not imported"))
+            continue
+        seen[key] = place
+        session["places"].append(place)
+        session[place] = {"gps": gps, "icb": entry["icb"]}
+        rows.append((place, entry["icb"], len(gps), missing_counts[number], other_icb_counts[number], "Imported"))
+
+    return session, pd.DataFrame(rows, columns=REPORT_COLUMNS)
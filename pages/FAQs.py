@@ -176,7 +176,7 @@ with st.expander("How do I download my saved places data?"):
         **3a)** Scroll down below the “Relative Need Index” to “Download Data”. Here you can preview the data download by ensuring the box “Preview data download” is ticked (this is ticked by default).
         \n\n**3b)** This section provides a preview of the data download. It includes the GP practices populations, weighted populations and need indices for all components, for the created places. It also includes this data for the ICB in which the places are located.
         \n\n***Please Note:** The ICB need indices are not comparable with the need indices of the created places. The former is relative to national need, while the place need indices are relative to ICB need.*
-        \n\n**3c)** To download the data, click “Download ZIP”. A date-stamped ZIP file will then be downloaded into your default download folder and contains the following items:
+        \n\n**3c)** To download the data, click “Prepare ZIP download”. Once the download has been prepared a “Download ZIP” button appears in its place; click it and a date-stamped ZIP file will then be downloaded into your default download folder. The download stays prepared until you change your saved places, so you only need to click “Prepare ZIP download” again after making changes. The ZIP file contains the following items:
     """)
     st.markdown("""
         - 'ICB allocation calculations.csv': The data you previewed under step 3b in a Comma Separated Value (.csv) file which can be opened as a table in Microsoft Excel.  If there are multiple years of data available in the tool, this download file will include each year in a separate tab.
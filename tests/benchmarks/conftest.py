@@ -0,0 +1,71 @@
+# Synthetic data for the benchmarks, scaling the schema of data/2025_2026.csv up to many more practices and places
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import compute
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SOURCE_CSV = os.path.join(ROOT, "data", "2025_2026.csv")
+
+# Sizes benchmarked: multiples of the rows in the source CSV, and numbers of places in the session
+SCALES = [1, 10, 100]
+PLACE_COUNTS = [1, 50, 500]
+
+
+def make_raw_dataset(scale, seed=0):
+    """
+    Returns a dataset in the raw CSV schema with scale times as many practices as the source CSV.
+    Each copy of the source rows gets new practice codes and slightly perturbed populations, and stays in its original ICB.
+    """
+    source = pd.read_csv(SOURCE_CSV)
+    rng = np.random.default_rng(seed)
+    copies = []
+    for copy in range(scale):
+        df = source.copy()
+        if copy:
+            df["Practice_Code"] = df["Practice_Code"] + f"-{copy}"
+            numeric = df.columns[df.columns.get_loc("Population"):]
+            df[numeric] = df[numeric] * rng.uniform(0.9, 1.1, size=(len(df), 1))
+        copies.append(df)
+    return pd.concat(copies, ignore_index=True)
+
+
+def make_session(data, place_count, seed=0):
+    """
+    Returns a session (in the layout of the tool's session JSON) with place_count places, each made of 1 to 60
+    practices drawn from a single ICB of data, the processed data returned by compute.read_data.
+    """
+    rng = np.random.default_rng(seed)
+    practices_by_icb = data.groupby("ICB name", observed=True)["practice_display"].apply(list)
+    session = {"places": []}
+    for number in range(place_count):
+        icb = practices_by_icb.index[rng.integers(len(practices_by_icb))]
+        practices = practices_by_icb[icb]
+        size = int(rng.integers(1, min(60, len(practices)) + 1))
+        name = f"Place {number}"
+        session[name] = {"gps": [str(gp) for gp in rng.choice(practices, size, replace=False)], "icb": icb}
+        session["places"].append(name)
+    return session
+
+
+@pytest.fixture(scope="session", params=SCALES, ids=[f"{scale}x" for scale in SCALES])
+def dataset_csv(request, tmp_path_factory):
+    """Path to a synthetic yearly CSV at each scale."""
+    path = tmp_path_factory.mktemp(f"data_{request.param}x") / "2025_2026.csv"
+    make_raw_dataset(request.param).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def dataset(dataset_csv):
+    """The processed synthetic dataset at each scale."""
+    return compute.read_data(dataset_csv)
+
+
+@pytest.fixture(scope="session", params=PLACE_COUNTS, ids=[f"{count}places" for count in PLACE_COUNTS])
+def session(request, dataset):
+    """A synthetic session with each number of places."""
+    # Round trips through JSON so the session is exactly as it would be loaded from a file
+    return json.loads(json.dumps(make_session(dataset, request.param)))
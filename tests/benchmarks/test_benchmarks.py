@@ -0,0 +1,64 @@
+# Benchmarks for the hot paths of the tool: loading, aggregating, indexing, rounding, the map lookup and the export
+# These are skipped in normal test runs; see the Benchmarks section of the README for how to run them and compare against a baseline
+import compute
+import utils
+
+
+def test_read_data(benchmark, dataset_csv):
+    benchmark.pedantic(compute.read_data, args=(dataset_csv,), rounds=3, iterations=1)
+
+
+def test_read_cached_data(benchmark, dataset_csv):
+    # Builds the cache file first, so this times loading from the cache
+    compute.read_cached_data(dataset_csv)
+    benchmark(compute.read_cached_data, dataset_csv)
+
+
+def test_get_data_for_all_years(benchmark, dataset, session):
+    benchmark(
+        lambda: compute.get_data_for_all_years(
+            {"2025_2026": dataset}, session, compute.AGGREGATIONS, compute.INDEX_NUMERATOR, compute.INDEX_NAMES
+        )
+    )
+
+
+def test_get_index(benchmark, dataset, session):
+    membership = compute.build_membership(session)
+    place_groupby = compute.aggregate_places(dataset, membership, compute.AGGREGATIONS)
+    icb_groupby = dataset.groupby("ICB name", observed=True).agg(compute.AGGREGATIONS)
+    place_icbs = [session[place]["icb"] for place in place_groupby.index]
+    benchmark(
+        lambda: compute.get_index(
+            place_groupby.copy(), icb_groupby.copy(), compute.INDEX_NAMES, compute.INDEX_NUMERATOR, place_icbs=place_icbs
+        )
+    )
+
+
+def test_excel_round_array(benchmark, dataset):
+    # Rounds every weighted population in the dataset, as many values as the largest sessions produce
+    values = dataset[compute.INDEX_NUMERATOR].to_numpy()
+    benchmark(compute.excel_round_array, values, 0.001)
+
+
+def test_find_practices(benchmark, dataset, session):
+    practice_index = compute.build_practice_index(dataset)
+    # The largest place in the session, as drawn on the map
+    gps = max((session[place]["gps"] for place in session["places"]), key=len)
+    benchmark(compute.find_practices, practice_index, gps)
+
+
+def test_build_practice_index(benchmark, dataset):
+    benchmark(compute.build_practice_index, dataset)
+
+
+def test_export(benchmark, dataset, session):
+    results = compute.get_data_for_all_years(
+        {"2025_2026": dataset}, session, compute.AGGREGATIONS, compute.INDEX_NUMERATOR, compute.INDEX_NAMES
+    )
+    headers = ["Header one", "Header two", "Header three", ""]
+    benchmark(
+        lambda: utils.write_zip({
+            "ICB allocation calculations.xlsx": utils.write_excel(results.items(), *headers),
+            "ICB allocation tool configuration file.json": "{}",
+        })
+    )
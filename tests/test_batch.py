@@ -0,0 +1,46 @@
+# Tests for the command-line batch tool in batch.py
+import json
+import subprocess
+import sys
+import pandas as pd
+import batch
+import compute
+
+
+def test_batch(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    weighted = [110.0, 290.0, 200.0]
+    pd.DataFrame({
+        "Practice_Code": ["A1", "A2", "B1"],
+        "GP_Practice_Name": ["ONE", "TWO", "THREE"],
+        "ICBname": ["ICB A", "ICB A", "ICB B"],
+        "Population": [100.0, 300.0, 200.0],
+        **{column: weighted for column in [
+            "G&A WP", "CS WP", "MH WP", "Mat WP", "Health Ineq WP", "Prescr WP", "Final WP", "Primary Medical Care WP", "Final PMC WP"
+        ]},
+    }).to_csv(data / "2025_2026.csv", index=False)
+
+    sessions = tmp_path / "sessions"
+    sessions.mkdir()
+    (sessions / "first.json").write_text(json.dumps({"places": ["Place"], "Place": {"gps": ["A1: ONE"], "icb": "ICB A"}}))
+    # A compressed session in the current format, whose practice has since been renamed
+    (sessions / "second.json.gz").write_bytes(
+        compute.write_session({"places": ["Place"], "Place": {"gps": ["A2: OLD NAME"], "icb": "ICB A"}}, "gzip")
+    )
+    (sessions / "broken.json").write_text("{")
+
+    output = tmp_path / "results.csv"
+    # The broken session is reported, and the rest are still written
+    assert batch.main([str(sessions), str(output), "--data", str(data), "--workers", "2"]) == 1
+    results = pd.read_csv(output)
+    assert results[["Session", "Year", "Place / ICB"]].values.tolist() == [
+        ["first", "2025_2026", "ICB A"], ["first", "2025_2026", "Place"],
+        ["second", "2025_2026", "ICB A"], ["second", "2025_2026", "Place"],
+    ]
+    assert results["Overall Core Index"].tolist() == [1.0, 1.1, 1.0, 0.967]
+
+
+def test_batch_does_not_import_streamlit():
+    code = "import sys, batch; assert not {'streamlit', 'st_aggrid', 'requests', 'xlsxwriter'} & set(sys.modules)"
+    subprocess.run([sys.executable, "-c", code], check=True, cwd=batch.__file__.rsplit("batch.py", 1)[0] or ".")
@@ -0,0 +1,122 @@
+# Tests for the compute package (the data functions are also tested through utils in test_utils.py)
+import json
+import os
+import subprocess
+import sys
+import compute
+from compute import caching
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Slowest acceptable import of the compute core, in seconds, including pandas and NumPy
+IMPORT_TIME_BUDGET = 3.0
+
+
+def _import_times(statement):
+    """Runs statement in a fresh interpreter with -X importtime, returning the modules imported and the total time in seconds."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_compute_import_is_lazy():
+    # Importing the package itself doesn't import any of its modules, or pandas
+    times = _import_times("import compute")
+    assert not {"pandas", "compute.loading", "compute.aggregation"} & set(times)
+
+
+def test_compute_import_time():
+    times = _import_times("import compute.loading, compute.aggregation, compute.rounding")
+    assert not {"streamlit", "st_aggrid", "requests", "xlsxwriter"} & set(times)
+    total = sum(times[name] for name in ["compute.loading", "compute.aggregation", "compute.rounding"] if name in times)
+    assert total < IMPORT_TIME_BUDGET, f"importing the compute core took {total:.3f}s"
+
+
+def test_cache_backend():
+    calls = []
+
+    @compute.cached
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert [double(1), double(1), double(2)] == [2, 2, 4]
+    assert calls == [1, 2]
+
+    # A plugged-in backend is used from the next call
+    backend_calls = []
+
+    def backend(func):
+        def wrapper(*args):
+            backend_calls.append(args)
+            return func(*args)
+        return wrapper
+
+    compute.set_cache_backend(backend)
+    try:
+        assert double(1) == 2
+        assert backend_calls == [(1,)]
+    finally:
+        compute.set_cache_backend(None)
+    assert compute.get_cache_backend() is caching.lru_backend
+
+
+def test_lru_backend():
+    double = caching.lru_backend(lambda x: [x * 2], maxsize=2)
+    first = double(1)
+    double(2)
+    assert double(1) is first
+    double(3)
+    # 2 was the least recently used, so it has been dropped, while 1 is still cached
+    assert double(1) is first
+    # Unhashable arguments aren't cached
+    assert double([1]) == [[1, 1]]
+
+
+def test_result_cache():
+    cache = compute.ResultCache(maxsize=2)
+    cache["a"] = 1
+    cache["b"] = None
+    # Cached None values are told apart from missing keys by the default
+    assert cache.get("b", "missing") is None
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    # b was the least recently used, so it has been dropped
+    assert "b" not in cache and len(cache) == 2
+    assert cache.get("b", "missing") == "missing"
+    assert cache.stats() == {"hits": 2, "misses": 1, "entries": 2, "maxsize": 2}
+
+
+def test_profiler():
+    @compute.timed
+    def add(a, b):
+        return a + b
+
+    # Without an active profiler nothing is recorded
+    compute.start_profiler(False)
+    assert add(1, 2) == 3
+    with compute.span("nothing"):
+        pass
+    assert compute.get_profiler() is None
+
+    profiler = compute.start_profiler()
+    compute.stage("First")
+    with compute.span("outer"):
+        add(1, 2)
+    compute.stage("Second")
+    add(3, 4)
+    profiler.stop()
+    assert compute.get_profiler() is None
+    assert [(record["path"], record["depth"]) for record in profiler.records()] == [
+        ("First", 0), ("First / outer", 1), ("First / outer / add", 2), ("Second", 0), ("Second / add", 1)
+    ]
+    assert json.loads(profiler.to_json())["total_seconds"] == profiler.total
+    prometheus = profiler.to_prometheus()
+    assert 'icb_tool_span_calls{span="Second / add"} 1' in prometheus
+    assert prometheus.count("# TYPE") == 3
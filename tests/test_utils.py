@@ -1,7 +1,22 @@
-
 # Tests for functions in utils will be written here
+import gzip
+import io
+import os
+import json
+import zipfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import pytest
-from utils import excel_round
+import numpy as np
+import pandas as pd
+import utils
+import compute.aggregation
+import compute.loading
+import compute.rollup
+from utils import excel_round, excel_round_array, get_data_for_all_years, read_cached_data, get_data_cache_path
+
+
 @pytest.mark.parametrize("value, precision, expected", [
     # Basic rounding with default precision
     (2.675, 0.01, 2.68),
@@ -42,6 +57,8 @@ from utils import excel_round
 ])
 def test_excel_round(value, precision, expected):
     assert excel_round(value, precision) == expected
+    assert excel_round_array([value], precision)[0] == expected
+
 
 @pytest.mark.parametrize("value, precision, expected", [
     # Test exceptions
@@ -52,4 +69,604 @@ def test_excel_round(value, precision, expected):
 ])
 def test_excel_round_exceptions(value, precision, expected):
     result = excel_round(value, precision)
-    assert result == expected
\ No newline at end of file
+    assert result == expected
+
+
+@pytest.mark.parametrize("precision", [1, 0.1, 0.01, 0.001, 0.0001, 100])
+def test_excel_round_array_matches_decimal(precision):
+    # Mixes values of all sizes with exact and near half-way points, which is where float and decimal rounding disagree
+    rng = np.random.default_rng(2025)
+    n = 100_000
+    values = np.concatenate([
+        rng.uniform(-10, 10, n),
+        rng.lognormal(0, 6, n) * rng.choice([-1, 1], n),
+        (rng.integers(-10 ** 7, 10 ** 7, n) + 0.5) * min(precision, 1),
+        np.round(rng.uniform(-1000, 1000, n), 4) + rng.choice([-1, 0, 1], n) * 1e-12,
+        np.array([0.0, -0.0, np.nan, 2.0 ** 60, -(2.0 ** 60) + 0.5]),
+    ])
+    expected = np.array([excel_round(float(value), precision) for value in values])
+    result = excel_round_array(values, precision)
+    # Compares the bit patterns so that -0.0 and NaN are checked too
+    assert np.array_equal(result.view(np.int64), expected.view(np.int64))
+
+
+def _practices():
+    return pd.DataFrame({
+        "practice_display": ["A1: ONE", "A2: TWO", "A3: THREE", "B1: FOUR", "B2: FIVE"],
+        "ICB name": ["ICB A", "ICB A", "ICB A", "ICB B", "ICB B"],
+        "GP pop": [100.0, 200.0, 300.0, 400.0, 500.0],
+        "Overall Weighted pop": [110.0, 180.0, 330.0, 400.0, 450.0],
+    })
+
+
+def _session():
+    return {
+        "places": ["North", "East", "Both"],
+        "North": {"gps": ["B1: FOUR", "B2: FIVE"], "icb": "ICB B"},
+        "East": {"gps": ["A1: ONE", "A2: TWO", "A2: TWO"], "icb": "ICB A"},
+        "Both": {"gps": ["A2: TWO", "A3: THREE", "Z9: MISSING"], "icb": "ICB A"},
+    }
+
+
+def test_get_data_for_all_years():
+    session = _session()
+    aggregations = {"GP pop": "sum", "Overall Weighted pop": "sum"}
+    result = get_data_for_all_years(
+        {"2025_2026": _practices()}, session, aggregations, ["Overall Weighted pop"], ["Overall Core Index"]
+    )["2025_2026"]
+
+    # Each ICB comes first, followed by its places in the order they were created
+    assert result["Place / ICB"].tolist() == ["ICB B", "North", "ICB A", "East", "Both"]
+    # Duplicated practices are only counted once and practices missing from the year are ignored
+    assert result["GP pop"].tolist() == [900.0, 900.0, 600.0, 300.0, 500.0]
+    # ICB indices are relative to national, place indices are relative to their ICB
+    assert result["Overall Core Index"].tolist() == [0.944, 1.0, 1.033, 0.935, 0.987]
+
+
+def test_get_data_for_all_years_icb_table():
+    aggregations = {"GP pop": "sum", "Overall Weighted pop": "sum"}
+    args = (aggregations, ["Overall Weighted pop"], ["Overall Core Index"])
+    icb_table = utils.build_icb_table(_practices(), *args)
+    assert icb_table.index.tolist() == ["ICB A", "ICB B"]
+
+    # Looking the ICBs up in the precomputed table gives the same result as aggregating them, and leaves the table alone
+    expected = get_data_for_all_years({"2025_2026": _practices()}, _session(), *args)["2025_2026"]
+    before = icb_table.copy()
+    result = get_data_for_all_years(
+        {"2025_2026": _practices()}, _session(), *args, icb_tables={"2025_2026": icb_table}
+    )["2025_2026"]
+    pd.testing.assert_frame_equal(result, expected)
+    pd.testing.assert_frame_equal(icb_table, before)
+
+
+def test_get_data_for_all_years_place_cache(monkeypatch):
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    session = _session()
+    place_cache = {}
+    first = get_data_for_all_years({"2025_2026": _practices()}, session, *args, place_cache=place_cache)["2025_2026"]
+    expected = get_data_for_all_years({"2025_2026": _practices()}, session, *args)["2025_2026"]
+    pd.testing.assert_frame_equal(first, expected)
+    assert len(place_cache) == 3
+
+    # Editing a place only aggregates that place, and the old row for it is dropped
+    aggregated = []
+    aggregate_places = compute.aggregation.aggregate_places
+    monkeypatch.setattr(
+        compute.aggregation,
+        "aggregate_places",
+        lambda data, membership, aggregations: aggregated.append(membership["Place Name"].unique().tolist())
+        or aggregate_places(data, membership, aggregations),
+    )
+    session["East"] = {"gps": ["A1: ONE"], "icb": "ICB A"}
+    result = get_data_for_all_years({"2025_2026": _practices()}, session, *args, place_cache=place_cache)["2025_2026"]
+    assert aggregated == [["East"]]
+    assert len(place_cache) == 3
+    monkeypatch.undo()
+    expected = get_data_for_all_years({"2025_2026": _practices()}, session, *args)["2025_2026"]
+    pd.testing.assert_frame_equal(result, expected)
+
+    # Deleting a place drops its row without aggregating anything
+    session["places"].remove("North")
+    result = get_data_for_all_years({"2025_2026": _practices()}, session, *args, place_cache=place_cache)["2025_2026"]
+    assert result["Place / ICB"].tolist() == ["ICB A", "East", "Both"]
+    assert len(place_cache) == 2
+
+
+def test_get_data_for_all_years_shared_cache():
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    cache = utils.ResultCache(maxsize=10)
+    expected = get_data_for_all_years({"2025_2026": _practices()}, _session(), *args)["2025_2026"]
+    get_data_for_all_years({"2025_2026": _practices()}, _session(), *args, place_cache=cache, versions={"2025_2026": 1})
+    assert cache.stats()["misses"] == 3
+
+    # Another session with one of the same places (in a different order of practices) reuses its row, and other sessions' rows are kept
+    session = {"places": ["Other"], "Other": {"gps": ["B2: FIVE", "B1: FOUR"], "icb": "ICB B"}}
+    result = get_data_for_all_years(
+        {"2025_2026": _practices()}, session, *args, place_cache=cache, versions={"2025_2026": 1}
+    )["2025_2026"]
+    assert cache.stats() == {"hits": 1, "misses": 3, "entries": 3, "maxsize": 10}
+    assert result.iloc[1, 1:].tolist() == expected.iloc[1, 1:].tolist()
+
+    # A new version of the data is never served rows calculated from the old one
+    get_data_for_all_years({"2025_2026": _practices()}, session, *args, place_cache=cache, versions={"2025_2026": 2})
+    assert cache.stats()["misses"] == 4 and len(cache) == 4
+
+    # Once full, the least recently used rows are dropped, and places whose rows were dropped are calculated again
+    small = utils.ResultCache(maxsize=2)
+    result = get_data_for_all_years({"2025_2026": _practices()}, _session(), *args, place_cache=small)["2025_2026"]
+    pd.testing.assert_frame_equal(result, expected)
+    assert len(small) == 2
+
+
+def test_get_data_for_all_years_place_cache_years():
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    # A1 closed in the later year
+    later = _practices().iloc[1:].assign(**{"Overall Weighted pop": [200.0, 300.0, 400.0, 500.0]})
+    expected = get_data_for_all_years({"2024_2025": _practices(), "2025_2026": later}, _session(), *args)
+
+    # Each year's places are cached apart, for a session's own cache and a shared one
+    for place_cache in [{}, utils.ResultCache(maxsize=10)]:
+        result = get_data_for_all_years(
+            {"2024_2025": _practices(), "2025_2026": later}, _session(), *args, place_cache=place_cache
+        )
+        assert len(place_cache) == 6
+        for year in expected:
+            pd.testing.assert_frame_equal(result[year], expected[year])
+
+    # Rows are keyed on the practice codes, so a place holding a practice under another name reuses them
+    cache = utils.ResultCache(maxsize=10)
+    get_data_for_all_years({"2024_2025": _practices()}, _session(), *args, place_cache=cache)
+    session = {"places": ["East"], "East": {"gps": ["A1: ONE", "A2: TWO RENAMED"], "icb": "ICB A"}}
+    result = get_data_for_all_years({"2024_2025": _practices()}, session, *args, place_cache=cache)["2024_2025"]
+    assert cache.stats()["hits"] == 1
+    assert result["GP pop"].tolist() == [600.0, 300.0]
+
+
+def test_get_longitudinal_data():
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    # A1 closed in the later year
+    later = _practices().iloc[1:].assign(**{"Overall Weighted pop": [200.0, 300.0, 400.0, 500.0]})
+    years = {"2025_2026": later, "2024_2025": _practices()}
+    result = utils.get_longitudinal_data(years, _session(), *args)
+
+    assert result[["Year", "Place / ICB", "Practices not available"]].values.tolist() == [
+        ["2024_2025", "ICB B", 0], ["2025_2026", "ICB B", 0],
+        ["2024_2025", "North", 0], ["2025_2026", "North", 0],
+        ["2024_2025", "ICB A", 0], ["2025_2026", "ICB A", 0],
+        ["2024_2025", "East", 0], ["2025_2026", "East", 1],
+        ["2024_2025", "Both", 1], ["2025_2026", "Both", 1],
+    ]
+    # Each year matches the single year calculation
+    for year, data in years.items():
+        expected = get_data_for_all_years({year: data}, _session(), *args)[year]
+        actual = result.loc[result["Year"] == year, expected.columns].reset_index(drop=True)
+        pd.testing.assert_frame_equal(actual, expected)
+    changes = result["Overall Core Index change"]
+    assert changes.isna().tolist() == [True, False] * 5
+    assert changes.iloc[3] == excel_round(result["Overall Core Index"].iloc[3] - result["Overall Core Index"].iloc[2], 0.001)
+
+
+def test_renamed_practice_across_years():
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    # A2 is renamed in the later year; the session holds the earlier name.  The later year holds practice_display as a categorical, as read_data does
+    later = _practices().assign(practice_display=pd.Categorical(["A1: ONE", "A2: TWO RENAMED", "A3: THREE", "B1: FOUR", "B2: FIVE"]))
+    later["GP Practice code"] = ["A1", "A2", "A3", "B1", "B2"]
+    years = {"2024_2025": _practices(), "2025_2026": later}
+
+    # The places are the same in both years
+    for year, data in years.items():
+        result = get_data_for_all_years({year: data}, _session(), *args)[year]
+        assert result["GP pop"].tolist() == [900.0, 900.0, 600.0, 300.0, 500.0]
+
+    result = utils.get_longitudinal_data(years, _session(), *args)
+    places = result.loc[result["Place / ICB"].isin(["East", "Both"])]
+    assert places["GP pop"].tolist() == [300.0, 300.0, 500.0, 500.0]
+    # Only the practice that isn't in either year is missing
+    assert places["Practices not available"].tolist() == [0, 0, 1, 1]
+    assert places["Overall Core Index change"].tolist()[1::2] == [0.0, 0.0]
+
+
+def test_get_data_for_all_years_progress(monkeypatch):
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    monkeypatch.setattr(compute.aggregation, "PROGRESS_CHUNK_SIZE", 2)
+    calls = []
+    years = {"2024_2025": _practices(), "2025_2026": _practices()}
+    result = get_data_for_all_years(years, _session(), *args, progress=lambda done, total: calls.append((done, total)))
+    # Progress is reported after each chunk of places in each year, ending with every place done
+    assert calls == [(2, 6), (3, 6), (3, 6), (5, 6), (6, 6), (6, 6)]
+    expected = get_data_for_all_years({"2025_2026": _practices()}, _session(), *args)["2025_2026"]
+    pd.testing.assert_frame_equal(result["2025_2026"], expected)
+
+    # Places already in the cache count as done straight away
+    place_cache = {}
+    get_data_for_all_years({"2025_2026": _practices()}, _session(), *args, place_cache=place_cache)
+    calls = []
+    get_data_for_all_years(
+        {"2025_2026": _practices()}, _session(), *args, place_cache=place_cache, progress=lambda *call: calls.append(call)
+    )
+    assert calls == [(3, 3), (3, 3)]
+
+
+def test_build_membership_matrix():
+    membership = utils.build_membership(_session())
+    matrix = utils.build_membership_matrix(_practices(), membership)
+    # Overlapping places share practices, and missing practices are dropped
+    assert matrix["places"] == ["North", "East", "Both"]
+    assert matrix["indptr"].tolist() == [0, 2, 4, 6]
+    assert matrix["indices"].tolist() == [3, 4, 0, 1, 1, 2]
+
+    sums = utils.aggregate_membership_matrix(_practices(), matrix, ["GP pop", "Overall Weighted pop"])
+    assert sums["GP pop"].tolist() == [900.0, 300.0, 500.0]
+
+    # The sparse sums are identical to grouping the joined data, including the order the values are added in
+    rng = np.random.default_rng(0)
+    data = _practices().assign(**{"GP pop": rng.random(5) * 1e4, "Overall Weighted pop": rng.random(5) * 1e4})
+    aggregations = {"GP pop": "sum", "Overall Weighted pop": "sum"}
+    joined = data.merge(membership, on=["practice_display", "ICB name"])
+    expected = joined.groupby("Place Name", sort=False).agg(aggregations).loc[matrix["places"]]
+    pd.testing.assert_frame_equal(utils.aggregate_places(data, membership, aggregations), expected, check_exact=True)
+
+
+def test_evaluate_designs():
+    data = _practices().assign(**{"LA District name": ["Kirk", "Kirk", "Cald", "Leeds", None]})
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    membership = pd.concat([
+        utils.build_grouping_membership(data, "ICB A", ["LA District name"]),
+        utils.build_design_membership({"Custom": {"Kirk": ["A2: TWO"], "Rest": ["A1: ONE", "A3: THREE", "Z9: MISSING"]}}),
+    ], ignore_index=True)
+    results = utils.evaluate_designs(data, "ICB A", membership, None, *args)
+
+    # Places with the same name in different designs are kept apart, and match the places of a session with the same practices
+    assert results[["Design", "Place Name", "Practices"]].values.tolist() == [
+        ["LA District name", "Kirk", 2],
+        ["LA District name", "Cald", 1],
+        ["Custom", "Kirk", 1],
+        ["Custom", "Rest", 2],
+    ]
+    session = {"places": ["Rest"], "Rest": {"gps": ["A1: ONE", "A3: THREE"], "icb": "ICB A"}}
+    expected = get_data_for_all_years({"2025_2026": data}, session, *args)["2025_2026"]
+    assert results["Overall Core Index"].tolist()[3] == expected["Overall Core Index"].tolist()[1]
+
+    # The custom design splits the ICB into places that differ more in need, so it is ranked first
+    comparison = utils.compare_designs(results, data, "ICB A")
+    assert comparison["Design"].tolist() == ["Custom", "LA District name"]
+    assert comparison["Rank"].tolist() == [1, 2]
+    assert comparison["GP pop covered (%)"].tolist() == [100.0, 100.0]
+
+    # Compared on the unrounded results, the spread is calculated before it is rounded
+    unrounded = utils.evaluate_designs(data, "ICB A", membership, None, *args, rounded=False)
+    pd.testing.assert_frame_equal(utils.round_results(unrounded.copy(), *args[1:]), results)
+    custom = unrounded.loc[unrounded["Design"] == "Custom"]
+    mean = np.average(custom["Overall Core Index"], weights=custom["GP pop"])
+    spread = np.sqrt(np.average((custom["Overall Core Index"] - mean) ** 2, weights=custom["GP pop"]))
+    comparison = utils.compare_designs(unrounded, data, "ICB A")
+    assert comparison["Overall Core Index spread"].iloc[0] == excel_round(spread, 0.001)
+
+
+def test_import_session():
+    session = _session()
+    session["places"] += ["East again", "Broken"]
+    session["East again"] = {"gps": ["A2: TWO", "A1: ONE"], "icb": "ICB A"}
+    session["Both"]["gps"].append("B1: FOUR")
+    text = json.dumps(session, indent=4)
+    assert [key for key, _ in utils.iter_session_items(text)] == ["places", "North", "East", "Both", "East again"]
+
+    imported, report = utils.import_session(text, _practices())
+    assert imported["places"] == ["North", "East", "Both"]
+    # Duplicate practices within a place are dropped
+    assert imported["East"] == {"gps": ["A1: ONE", "A2: TWO"], "icb": "ICB A"}
+    assert report.values.tolist() == [
+        ["North", "ICB B", 2, 0, 0, "Imported"],
+        ["East", "ICB A", 2, 0, 0, "Imported"],
+        ["Both", "ICB A", 4, 1, 1, "Imported"],
+        ["East again", "ICB A", 2, 0, 0, "Duplicate of East, not imported"],
+        ["Broken", None, 0, 0, 0, "Invalid: no practices and ICB found for this place"],
+    ]
+
+    # Written in the current format, the places are matched on their practice codes, so renamed practices are still found
+    renamed = _practices().assign(practice_display=["A1: ONE", "A2: TWO (RENAMED)", "A3: THREE", "B1: FOUR", "B2: FIVE"])
+    for encoding in ["json", "gzip"]:
+        content = utils.write_session(imported, encoding)
+        assert json.loads(gzip.decompress(content) if encoding == "gzip" else content)["places"][1] == {
+            "name": "East", "icb": "ICB A", "practices": ["A1", "A2"]
+        }
+        reimported, report = utils.import_session(content, renamed)
+        assert reimported["places"] == ["North", "East", "Both"]
+        assert reimported["East"] == {"gps": ["A1: ONE", "A2: TWO (RENAMED)"], "icb": "ICB A"}
+        # Practices are written in code order, and those missing from the data keep their code
+        assert reimported["Both"]["gps"] == ["A2: TWO (RENAMED)", "A3: THREE", "B1: FOUR", "Z9"]
+        assert report["Missing practices"].tolist() == [0, 0, 1]
+    # Files from before the format was versioned are matched on their codes too
+    assert utils.import_session(text, renamed)[0]["East"]["gps"] == ["A1: ONE", "A2: TWO (RENAMED)"]
+
+    with pytest.raises(ValueError):
+        utils.import_session(b'{"version": 3, "places": []}', _practices())
+    with pytest.raises(ValueError):
+        utils.import_session(b"\x1f\x8bnot gzip", _practices())
+    with pytest.raises(ValueError):
+        utils.import_session('{"places": ["North"] "North": {}}', _practices())
+    with pytest.raises(ValueError):
+        utils.import_session('{"North": {}}', _practices())
+
+
+def _write_csv(path, patients):
+    pd.DataFrame({
+        "Practice_Code": ["A1", "A2"],
+        "GP_Practice_Name": ["ONE", "TWO"],
+        "ICBname": ["ICB A", "ICB A"],
+        "PCN_Code": [None, None],
+        "Population": patients,
+    }).to_csv(path, index=False)
+
+
+def test_read_cached_data(tmp_path, monkeypatch):
+    path = str(tmp_path / "2025_2026.csv")
+    _write_csv(path, [100.0, 200.0])
+
+    df = read_cached_data(path)
+    assert os.path.exists(get_data_cache_path(path))
+    pd.testing.assert_frame_equal(df, utils.read_data(path))
+
+    # Once cached, the csv isn't parsed again, even if it has been touched without changing
+    os.utime(path, ns=(0, 0))
+    monkeypatch.setattr(compute.loading, "read_data", lambda *args: pytest.fail("csv was re-read"))
+    pd.testing.assert_frame_equal(read_cached_data(path), df)
+    monkeypatch.undo()
+
+    # Changing the csv rebuilds the cache
+    _write_csv(path, [100.0, 250.0])
+    assert read_cached_data(path)["GP pop"].tolist() == [100.0, 250.0]
+
+    # Asking for a different population dtype rebuilds the cache too
+    assert read_cached_data(path, "float32")["GP pop"].dtype == np.float32
+
+
+def test_read_data_schema(tmp_path):
+    path = str(tmp_path / "2025_2026.csv")
+    _write_csv(path, [100.0, 200.0])
+    df = utils.read_data(path)
+
+    # Geography columns are categoricals, with blanks left missing rather than filled with 0
+    assert isinstance(df["ICB name"].dtype, pd.CategoricalDtype)
+    assert df["ICB name"].cat.categories.tolist() == ["ICB A"]
+    assert df["PCN code"].isna().all()
+    assert isinstance(df["practice_display"].dtype, pd.CategoricalDtype)
+    assert df["practice_display"].tolist() == ["A1: ONE", "A2: TWO"]
+    assert df["GP pop"].dtype == np.float64
+    assert utils.read_data(path, population_dtype="float32")["GP pop"].dtype == np.float32
+
+
+def test_build_rollup(tmp_path, monkeypatch):
+    data = _practices().assign(**{
+        "ICB code": ["QA", "QA", "QA", "QB", "QB"],
+        "Region code": ["R1", "R1", "R1", "R1", "R1"],
+        "Region name": ["North"] * 5,
+        # Scaled so England's weighted population equals its GP population, as in the real data
+        "Overall Weighted pop": [110.0, 180.0, 330.0, 400.0, 480.0],
+    })
+    args = ({"GP pop": "sum", "Overall Weighted pop": "sum"}, ["Overall Weighted pop"], ["Overall Core Index"])
+    cube = utils.build_rollup(data, *args)
+
+    # Levels without codes in the data have no rows; England is the whole dataset
+    assert cube.groupby("Level", sort=False).size().to_dict() == {"ICB": 2, "Region": 1, "England": 1}
+    assert utils.get_rollup_level(cube, "ICB", *args[1:])[["Code", "Name", "GP pop"]].values.tolist() == [
+        ["QA", "ICB A", 600.0],
+        ["QB", "ICB B", 900.0],
+    ]
+    england = utils.get_rollup_level(cube, "England", *args[1:])
+    assert england["GP pop"].tolist() == [1500.0] and england["Overall Core Index"].tolist() == [1.0]
+
+    # Place indices relative to England are the place's weighted population per head over England's
+    places = utils.get_national_place_indices(data, _session(), cube, *args)
+    assert places["Place Name"].tolist() == ["North", "East", "Both"]
+    assert places["Overall Core Index"].tolist() == [0.978, 0.967, 1.02]
+
+    # The cube is cached next to the data cache, and only rebuilt when the data changes
+    path = str(tmp_path / "2025_2026.csv")
+    _write_csv(path, [100.0, 200.0])
+    calls = []
+    monkeypatch.setattr(compute.rollup, "build_rollup", lambda data: calls.append(path) or utils.build_rollup(data, *args))
+    csv_data = read_cached_data(path).assign(**{"Overall Weighted pop": [90.0, 210.0]})
+    cube = utils.read_cached_rollup(path, csv_data)
+    assert os.path.exists(get_data_cache_path(path, ".rollup"))
+    pd.testing.assert_frame_equal(utils.read_cached_rollup(path, csv_data), cube)
+    assert len(calls) == 1
+    _write_csv(path, [100.0, 250.0])
+    utils.read_cached_rollup(path, csv_data)
+    assert len(calls) == 2
+
+
+def test_dataset_registry(tmp_path):
+    for year, patients in [("2023_2024", 10.0), ("2024_2025", 20.0), ("2025_2026", 30.0)]:
+        _write_csv(str(tmp_path / f"{year}.csv"), [patients, patients])
+    registry = utils.DatasetRegistry(str(tmp_path), max_loaded=2)
+
+    assert sorted(registry.years) == ["2023_2024", "2024_2025", "2025_2026"]
+    # Nothing is loaded until a year is asked for
+    assert registry.loaded_years() == []
+
+    assert registry.get("2023_2024")["GP pop"].tolist() == [10.0, 10.0]
+    registry.get("2024_2025")
+    registry.get("2023_2024")
+    registry.get("2025_2026")
+    # The least recently used year is dropped once more than max_loaded years are held
+    assert registry.loaded_years() == ["2023_2024", "2025_2026"]
+
+    # Derived items are built from the data of the entry they are held with, even if another session loads a year in between
+    get = registry.get
+    registry.get = lambda year: (get(year), get("2024_2025"), get("2023_2024"))[0]
+    assert registry.derive("2025_2026", "pop", lambda data: data["GP pop"].sum()) == 60.0
+    registry.get = get
+    _write_csv(str(tmp_path / "2025_2026.csv"), [40.0, 40.0])
+    os.utime(str(tmp_path / "2025_2026.csv"), ns=(1, 1))
+    assert registry.derive("2025_2026", "pop", lambda data: data["GP pop"].sum()) == 80.0
+
+
+def test_get_longitudinal_data_registry(tmp_path):
+    for year, patients in [("2024_2025", [10.0, 30.0]), ("2025_2026", [20.0, 20.0])]:
+        _write_csv(str(tmp_path / f"{year}.csv"), patients)
+    registry = utils.DatasetRegistry(str(tmp_path), max_loaded=1)
+    session = {"places": ["West"], "West": {"gps": ["A1: ONE"], "icb": "ICB A"}}
+    args = ({"GP pop": "sum"}, ["GP pop"], ["GP pop Index"])
+
+    # The years are read through the registry one at a time, so it never holds more than max_loaded years
+    loaded = []
+    get = registry.get
+    registry.get = lambda year: (get(year), loaded.append(len(registry.loaded_years())))[0]
+    result = utils.get_longitudinal_data(registry, session, *args)
+    assert loaded == [1, 1]
+
+    expected = utils.get_longitudinal_data({year: get(year) for year in registry.years}, session, *args)
+    pd.testing.assert_frame_equal(result, expected)
+    assert result.loc[result["Place / ICB"] == "West", "GP pop"].tolist() == [10.0, 20.0]
+
+
+def test_select_practices():
+    data = _practices().assign(**{"LA District name": ["Kirk", "Cald", "Kirk", "Leeds", "Leeds"]}).iloc[::-1]
+    selection_index = utils.build_selection_index(data)
+    assert selection_index["icbs"] == ["ICB A", "ICB B"]
+    # LA Districts are in the order they appear in the data, practices are sorted
+    assert list(selection_index["lads"]["ICB A"]) == ["Kirk", "Cald"]
+    assert utils.select_practices(selection_index, "ICB A") == ["A1: ONE", "A2: TWO", "A3: THREE"]
+    assert utils.select_practices(selection_index, "ICB A", ["Cald", "Kirk"]) == ["A1: ONE", "A2: TWO", "A3: THREE"]
+    assert utils.select_practices(selection_index, "ICB A", ["Kirk"]) == ["A1: ONE", "A3: THREE"]
+    assert utils.select_practices(selection_index, "ICB B", ["Kirk"]) == []
+
+
+def test_find_practices():
+    data = _practices().assign(
+        **{"GP Practice code": ["A1", "A2", "A3", "B1", "B2"], "Latitude": [50.0, 51.0, 52.0, 53.0, 54.0], "Longitude": [-1.0, -2.0, -3.0, -4.0, -5.0]}
+    )
+    practice_index = utils.build_practice_index(data)
+
+    found, positions, missing = utils.find_practices(practice_index, ["B2: FIVE", "Z9: MISSING", "A1: ONE"])
+    assert found == ["B2: FIVE", "A1: ONE"]
+    assert missing == ["Z9: MISSING"]
+    assert practice_index["latitude"][positions].tolist() == [54.0, 50.0]
+
+    found, positions, missing = utils.find_practices(practice_index, ["A3", "B1"], key="code")
+    assert practice_index["longitude"][positions].tolist() == [-3.0, -4.0]
+
+
+@pytest.fixture
+def github_stub():
+    """Runs a local stub of the GitHub commits API, returning whatever the test sets as its status and body."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.requests.append(self.path)
+            time.sleep(server.delay)
+            self.send_response(server.status)
+            self.end_headers()
+            self.wfile.write(json.dumps(server.body).encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    server.status, server.delay, server.requests = 200, 0, []
+    server.body = [{"commit": {"committer": {"date": "2025-10-02T09:30:00Z"}}}]
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def test_get_latest_commit_date(github_stub):
+    assert utils.get_latest_commit_date("owner", "repo", "main", api_url=github_stub.url) == "02 October 2025"
+    assert utils.get_latest_folder_update("owner", "repo", "data", "main", api_url=github_stub.url) == "02 October 2025"
+    assert "path=data" in github_stub.requests[-1]
+
+    github_stub.status = 403
+    assert utils.get_latest_commit_date("owner", "repo", "main", api_url=github_stub.url) == "GitHub API error: 403"
+
+    github_stub.status, github_stub.delay = 200, 1
+    assert utils.get_latest_commit_date("owner", "repo", "main", api_url=github_stub.url, timeout=0.2).startswith("GitHub API error")
+
+
+def test_last_updated_cache(github_stub):
+    cache = utils.LastUpdatedCache(ttl=60)
+    fetch = lambda: utils.fetch_latest_update("owner", "repo", "main", api_url=github_stub.url)
+    fallback = lambda: "local date"
+
+    # The first read doesn't wait for GitHub or the local date, it returns the default while both are found in the background
+    assert cache.get("commit", fetch, fallback, default="unknown") == "unknown"
+    for _ in range(50):
+        if cache.get("commit", fetch, fallback) == "02 October 2025":
+            break
+        time.sleep(0.05)
+    assert cache.get("commit", fetch, fallback) == "02 October 2025"
+    # Later reads within the ttl are served from the cache
+    assert len(github_stub.requests) == 1
+
+    # If GitHub can't be reached the local date is kept
+    github_stub.status = 500
+    assert cache.refresh("data", fetch, fallback) == "local date"
+
+    # If the local date can't be found either, nothing is stored and a later read tries again
+    calls = []
+
+    def broken():
+        calls.append(None)
+        raise OSError("not a git checkout")
+
+    for _ in range(50):
+        assert cache.get("local", fetch, broken, default="unknown") == "unknown"
+        if len(calls) >= 2:
+            break
+        time.sleep(0.05)
+    assert len(calls) >= 2
+
+
+def test_write_table(monkeypatch):
+    st_aggrid = pytest.importorskip("st_aggrid")
+    sent = []
+    monkeypatch.setattr(st_aggrid, "AgGrid", lambda data, gridOptions: sent.append((data, gridOptions)))
+    df = pd.DataFrame({"Place / ICB": [f"P{i}" for i in range(120)], "GP pop": np.arange(120.0)})
+
+    # Only the rows of the page are sent, with the first column frozen
+    assert utils.get_page_count(len(df), 50) == 3
+    utils.write_table(df, page=3, page_size=50)
+    data, options = sent[0]
+    assert data["Place / ICB"].tolist() == [f"P{i}" for i in range(100, 120)]
+    assert [column.get("pinned") for column in options["columnDefs"]] == ["left", None]
+    assert utils.get_page_count(0, 50) == 1
+
+    # The grid options depend only on the schema, so they are the same whichever rows are shown
+    utils.write_table(df)
+    assert len(sent[1][0]) == 120 and sent[1][1] == options
+
+
+def test_build_map_html():
+    pytest.importorskip("folium")
+    gps = ["A1: ONE", "A2: TWO", "A3: THREE"]
+    latitudes, longitudes = np.array([53.0, 53.5, 54.0]), np.array([-1.0, -1.5, -2.0])
+
+    # Small places have a marker each; the bounds come from the coordinate arrays, with a margin on the latitude
+    html = utils.build_map_html(gps, latitudes, longitudes)
+    assert html.count("L.marker(") == 3
+    assert "[[52.98, -2.0], [54.02, -1.0]]" in html
+
+    # Larger places are clustered, with the markers created in the browser from one array of coordinates and labels
+    clustered = utils.build_map_html(gps, latitudes, longitudes, cluster_threshold=2)
+    assert clustered.count("L.marker(") == 1
+    assert "markerClusterGroup" in clustered and '[53.0, -1.0, "A1: ONE"]' in clustered
+    assert "[[52.98, -2.0], [54.02, -1.0]]" in clustered
+
+
+def test_write_excel():
+    df = pd.DataFrame({"Place / ICB": ["ICB A", "East"], "GP pop": [600.0, 300.0], "Overall Core Index": [1.033, 0.935]})
+    excel = utils.write_excel([("2024_2025", df), ("2025_2026", df)], "Header one", "")
+    archive = zipfile.ZipFile(io.BytesIO(utils.write_zip({"results.xlsx": excel, "session.json": "{}"})))
+    assert archive.namelist() == ["results.xlsx", "session.json"]
+
+    workbook = zipfile.ZipFile(io.BytesIO(archive.read("results.xlsx")))
+    assert "Allocations for 2025_2026" in workbook.read("xl/workbook.xml").decode()
+    sheet = workbook.read("xl/worksheets/sheet1.xml").decode()
+    # Headers, then a blank row, then the column names on row 4 and the data from row 5
+    for text in ["Header one", '<row r="4"', "Overall Core Index", '<row r="6"', "East", "<v>1.033</v>"]:
+        assert text in sheet
+
+
+def test_get_content_hash():
+    assert utils.get_content_hash("session", [("2025_2026", (1, 2))]) == utils.get_content_hash("session", [("2025_2026", (1, 2))])
+    assert utils.get_content_hash("session", [("2025_2026", (1, 2))]) != utils.get_content_hash("session", [("2025_2026", (1, 3))])
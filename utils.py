@@ -1,103 +1,131 @@
 # Libraries
 # -------------------------------------------------------------------------
-import streamlit as st
-from st_aggrid import AgGrid, GridOptionsBuilder
-
-import pandas as pd
-from decimal import Decimal, ROUND_HALF_UP
+# Streamlit, st_aggrid and requests are only imported by the functions that use them, and the data functions live in
+# the compute package, so utils imports quickly and can be used without Streamlit
+import hashlib
+import io
+import json
 import os
-import requests
+import subprocess
+import threading
+import time
+import zipfile
 from datetime import datetime
 
-
-# Load data and cache
-# Uses the Streamlit cache decorator to cache this operation so the data doesn't have to be read in everytime script is re-run
-@st.cache_data()
-# Defines the get_data function
-def get_data(path):
+import pandas as pd
+import xlsxwriter
+
+# The data loading, aggregation and rounding functions are defined in the compute package and are available from utils as before
+from compute.caching import ResultCache, cached
+from compute.profiling import Profiler, start_profiler, get_profiler, span, stage, timed
+from compute.loading import (
+    DATA_CACHE_VERSION,
+    DATA_CACHE_FOLDER,
+    read_data,
+    get_data_cache_path,
+    get_file_hash,
+    read_cached_data,
+    get_data,
+    DatasetRegistry,
+    build_practice_index,
+    build_selection_index,
+    select_practices,
+    find_practices,
+)
+from compute.aggregation import (
+    AGGREGATIONS,
+    INDEX_NUMERATOR,
+    INDEX_NAMES,
+    aggregate,
+    get_index,
+    get_icb_index,
+    get_place_index,
+    build_icb_table,
+    build_membership,
+    build_membership_matrix,
+    aggregate_membership_matrix,
+    aggregate_places,
+    round_results,
+    get_data_for_all_years,
+    get_longitudinal_data,
+)
+from compute.rounding import excel_round, excel_round_array
+from compute.sessions import (
+    SESSION_VERSION,
+    SESSION_ENCODINGS,
+    iter_session_items,
+    write_session,
+    parse_session,
+    resolve_session,
+    import_session,
+)
+from compute.rollup import (
+    ROLLUP_LEVELS,
+    build_rollup,
+    read_cached_rollup,
+    get_rollup_level,
+    get_national_place_indices,
+)
+from compute.scenarios import (
+    GROUPING_COLUMNS,
+    build_grouping_membership,
+    build_design_membership,
+    evaluate_designs,
+    compare_designs,
+)
+
+
+# Grid options for a table schema, built once per schema rather than from the whole dataframe on every rerun
+@cached
+def get_grid_options(schema):
     """
-    Loads data from a csv at the provided location and stores it in a dataframe.
-    Specified columns are renamed as below and nulls are replaced with zeroes.
-    Prints 'cache miss' to the terminal before loading, to identify that this function is actually running, vs just pulling from cache.
-    
+    Builds the AgGrid options for a table, with the first column frozen.
+
     Parameters:
-    path: The location of the CSV to be loaded.
-    
+    schema: A tuple of (column name, dtype name) pairs, e.g. tuple(zip(df.columns, df.dtypes.astype(str))).
+
     Returns:
-    df: The data frame containing the CSV data, with columns renamed
+    gridOptions: The AgGrid options dictionary
     """
-    print('cache miss')
-    # Creates a dataframe using the csv found at the location the function is called on
-    df = pd.read_csv(path)
-    # Renames the columns as below
-    df = df.rename(
-        columns={
-            "Practice_Code": "GP Practice code",
-            "GP_Practice_Name": "GP Practice name",
-            "Practice_Postcode": "GP Practice postcode",
-            "CCG": "CCG code",
-            "Former CCG": "CCG name",
-            "PCN_Code": "PCN code",
-            "PCN_Name": "PCN name",
-            "LOC": "Location code",
-            "LOCname": "Location name",
-            "ICB": "ICB code",
-            "ICBname": "ICB name",
-            "RCode": "Region code",
-            "Region": "Region name",
-            "LAD": "LA District code",
-            "LTLA": "LA District name",
-            "LA": "LA code",
-            "UTLA": "LA name",
-            "Patients": "Registered Patients",
-            "Population": "GP pop",
-            "G&A WP": "Weighted G&A pop",
-            "CS WP": "Weighted Community pop",
-            "MH WP": "Weighted Mental Health pop",
-            "Mat WP": "Weighted Maternity pop",
-            "Health Ineq WP": "Weighted Health Inequalities pop",
-            "Prescr WP": "Weighted Prescribing pop",
-            "Final WP": "Overall Weighted pop",
-            "Primary Medical Care WP": "Weighted Primary Medical Care Need",
-            "Final PMC WP": "Weighted Primary Care",
-        }
-    )
-    # Replaces any NA values with zeroes
-    df = df.fillna(0)
-    # Creates a 'practice_display' column by combining the practice code and name into a single field.
-    df["practice_display"] = df["GP Practice code"] + ": " + df["GP Practice name"]
-    return df
+    from st_aggrid import GridOptionsBuilder
 
-
-# Sidebar dropdown list
-@st.cache_data
-def get_sidebar(data):
-    icb = data["ICB name"].unique().tolist()
-    icb.sort()
-    return icb
+    # The options only depend on the column names and types, so they are built from an empty frame with the same schema
+    gb = GridOptionsBuilder.from_dataframe(pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in schema}))
+    # Freeze the first column (index 0)
+    gb.configure_column(schema[0][0], pinned='left')
+    # Build the gridOptions dictionary
+    return gb.build()
 
 
 # Function to render a table with AgGrid options
-def write_table(data):
+@timed
+def write_table(data, page=1, page_size=None):
     """
     Renders a table with the first column frozen and no bottom-bar.
+    If page_size is given, only the rows of one page are sent to the browser (see get_page_count).
 
     Parameters:
     data: The dataframe to be displayed in a table.
+    page: The page of rows to display, counting from 1.
+    page_size: The number of rows on a page, or None to display every row.
 
     Returns:
     AgGrid: The information from the dataframe plus the selected AgGrid options.
     """
-    # Create grid options to pin the first column
-    gb = GridOptionsBuilder.from_dataframe(data)
-    # Freeze the first column (index 0)
-    gb.configure_column(list(data.columns)[0], pinned='left')
-    # Build the gridOptions dictionary
-    gridOptions = gb.build()
+    from st_aggrid import AgGrid
+
+    gridOptions = get_grid_options(tuple(zip(data.columns, data.dtypes.astype(str))))
+    if page_size is not None:
+        data = data.iloc[(page - 1) * page_size:page * page_size]
     # Display the table with AgGrid
     return AgGrid(data, gridOptions=gridOptions)
 
 
+def get_page_count(rows, page_size):
+    """Returns the number of pages needed to display the given number of rows, page_size at a time (at least 1)."""
+    return max(1, -(-rows // page_size))
+
+
 def write_headers(sheet, *csv_headers):
     """
     Function takes an unlimited amount of headers and writes them to the top of an excel sheet
@@ -118,187 +146,126 @@ def write_headers(sheet, *csv_headers):
     return header_row_count + 1  # Return the starting row for data
 
 
-# Creates the aggregate function
-def aggregate(df, name, on, aggregations):
+@timed
+def write_excel(data_by_year, *csv_headers):
     """
-    Function aggregates a data frame.  How the data is grouped and which aggregations are performed depends on given inputs.
-    Also checks that the df includes the specified "on" column and, if not, creates it, populating it with the name value, before aggregating.
-    Used exclusively in the get_data_all_years function.  When called there, the inputs are as below.
-    
+    Writes the aggregated data for each year to its own worksheet of an Excel workbook, below the given headers.
+    Uses xlsxwriter's constant_memory mode, which flushes each row to disk as soon as it is written, so memory use doesn't grow with the size of the workbook.
+    As constant_memory requires rows to be written in order, each column is converted to Python values in one go and the rows are then written from those lists.
+
     Parameters:
-    df: The pre-filtered (using a query string) data from the dataset_dict, containing only a single place or ICB before aggregation.
-    name: The place taken from the session_state.places list, used to populate the "on" field, if it's not already in the data.
-    on: Either the string "Place Name" or "ICB name", telling the function what to group on.  Both variations are called in the get_data_all_years function to create aggregations at both place-level and ICB-level.
-    aggregations: The library of column names and the aggregation functions to be performed on them, defined in the ICB_Place_Based_Tool.py file
+    data_by_year: An iterable of (year, df) pairs, e.g. dict.items() of the output of get_data_for_all_years.  May be a generator, so years can be computed one at a time.
+    *csv_headers (str): individual strings with the header information, written to the top of each sheet (see write_headers)
 
     Returns:
-    df: The same df as initially loaded
-    df_group: The aggregated and grouped df
+    bytes: The contents of the xlsx file
     """
-    if on not in df.columns:
-        df.insert(loc=0, column=on, value=name)
-
-    df_group = df.groupby(on).agg(aggregations)
-
-    return df, df_group
-
-
-# Creates a function to calculate the index of weighted populations.
-def get_index(place_indices, icb_indices, index_names, index_numerator):
+    excel_buffer = io.BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buffer, {"constant_memory": True})
+    for year, df in data_by_year:
+        # Sets the name for each tab in the workbook, appending the year to the end, replacing "/" with "_"
+        worksheet = workbook.add_worksheet(f"Allocations for {year}".replace("/", "_"))
+        # Adds the headers to the sheet and returns the correct row to load the data from
+        start_row = write_headers(worksheet, *csv_headers)
+        worksheet.write_row(start_row, 0, df.columns)
+        # Converts the data one column at a time, then writes it out row by row
+        columns = [df[column].tolist() for column in df.columns]
+        for r, row in enumerate(zip(*columns), start=start_row + 1):
+            worksheet.write_row(r, 0, row)
+    workbook.close()
+    return excel_buffer.getvalue()
+
+
+@timed
+def write_zip(files):
     """
-    Calculates the index of weighted populations.
-    Intended to take the df_group output from the aggregate function and divide it by the GP population, for ICB and place.
-    The place index is then divided by the icb index to create a relative number.
-    The overall index is created by final_wp divided by [GP pop].
-    
+    Creates a ZIP file containing the given files.
+
     Parameters:
-    place_indices: A df with place-level data
-    icb_indices: A df with ICB-level data
-    index_names: List of the indexes to be created.  Defined in ICB_Place_Based_Tool.py
-    index_numerator: List of column names that contain the numerator values for the index calculation.  Defined in ICB_Place_Based_Tool.py
+    files: A dictionary of filename -> contents (str or bytes)
 
     Returns:
-    place_indices: Input place_indices df with new index_names column
-    icb_indices: Input icb_indices df with new index_names column
+    bytes: The contents of the ZIP file
     """
-    # Creates a new column in icb_indices called "index_names", containing [index_numerator] / [GP pop]
-    icb_indices[index_names] = icb_indices[index_numerator].div(
-        icb_indices["GP pop"].values, axis=0
-    )
-    # Creates a new column in place_indices called "index_names", containing ([index_numerator] / [GP pop]) / ICB index
-    place_indices[index_names] = (
-        place_indices[index_numerator]
-        .div(place_indices["GP pop"].values, axis=0)
-        .div(icb_indices[index_names].values, axis=0)
-    )
-    return place_indices, icb_indices
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
+        for filename, contents in files.items():
+            zip_file.writestr(filename, contents)
+    return zip_buffer.getvalue()
 
 
-def get_data_for_all_years(dataset_dict, session_state, aggregations, index_numerator, index_names, gp_query, icb_query):
+def get_content_hash(*parts):
     """
-    Processes and aggregates data for all datasets across multiple years.
-
-    This function iterates over all datasets in the given `dataset_dict`, aggregates data for each place
-    and Integrated Care Board (ICB) specified in the `session_state`, and calculates indices based on the 
-    provided aggregation functions and queries. The aggregated and indexed data is then stored back in 
-    the `dataset_dict` for each dataset.
+    Returns a SHA-256 hash identifying the given content, used as a cache key for outputs built from it.
 
     Parameters:
-    ----------
-    dataset_dict : dict
-        A dictionary where the keys are filenames and the values are corresponding datasets (DataFrames). When called in the tool this is the imported data with a dataframe for each year.
-        
-    session_state : object
-        An object that contains the session state, including a list of places and corresponding 
-        geographical and ICB information for each place.
-        
-    aggregations : dict
-        A dictionary specifying the aggregation functions to apply to the data. The keys are column names
-        and the values are aggregation functions (e.g., 'sum', 'mean').
-
-    index_numerator : str
-        The column name to use as the numerator for index calculations.
-
-    index_names : list
-        A list of column names to use as the denominator for index calculations.
-
-    gp_query : str
-        A query string to filter the data for place-level aggregations.
-
-    icb_query : str
-        A query string to filter the data for ICB-level aggregations.
+    *parts: Any values that can be written as JSON (strings, numbers, lists, dicts), e.g. the session data and dataset versions.
 
     Returns:
-    -------
-    dict
-        The updated `dataset_dict` where each dataset (DataFrame) has been aggregated, indexed, and rounded 
-        to three decimal places. Each dataset is a DataFrame with data aggregated at the ICB and place level.
-
+    string: The hash, as a hex string
     """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
 
-    # Loop through all datasets
-    # This has potential to take time but I think with the size of data it's neglible.
-    for filename, data in dataset_dict.items():
-        # dict to store all dfs sorted by ICB
-        dict_obj = {}
-        df_list = []
-
-        #FOR EACH PLACE in the SESSION STATE aggregate the data at the ICB and Place level, calculate indices 
-        #adds them to a dictionary object
-        for place in session_state.places:
-            place_state = session_state[place]["gps"]
-            icb_state = session_state[place]["icb"]
-
-            # get place aggregations
-            df = data.query(gp_query)
-            place_data, place_groupby = aggregate(
-                df, place, "Place Name", aggregations
-            )
-
-            # get ICB aggregations
-            df = data.query(icb_query)
-            icb_data, icb_groupby = aggregate(
-                df, icb_state, "ICB name", aggregations
-            )
-
-            # index calcs
-            place_indices, icb_indices = get_index(
-                place_groupby, icb_groupby, index_names, index_numerator
-            )
-
-            icb_indices.insert(loc=0, column="Place / ICB", value=icb_state)
-            place_indices.insert(loc=0, column="Place / ICB", value=place)
-
-            if icb_state not in dict_obj:
-                dict_obj[icb_state] = [icb_indices, place_indices]
-            else:
-                dict_obj[icb_state].append(place_indices)
-
-        # add dict values to list
-        for obj in dict_obj:
-            df_list.append(dict_obj[obj])
 
-        # flatten list for concatenation
-        flat_list = [item for sublist in df_list for item in sublist]
-        large_df = pd.concat(flat_list, ignore_index=True)
+# Places with more practices than this are drawn with clustered markers, built in the browser from a single array of coordinates
+MAP_CLUSTER_THRESHOLD = 50
 
-        # Rounding the data here, after calculations are done to maintain accuracy - numerators and indices are rounded differently
-        large_df[index_numerator + ["GP pop"]] = large_df[index_numerator + ["GP pop"]].map(lambda x: excel_round(x, 1))
-        large_df[index_names] = large_df[index_names].map(lambda x: excel_round(x, 0.001))
+# Creates each clustered marker in the browser, with the same icon and popup as the individual markers
+MAP_CLUSTER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: "fa-user-md", prefix: "fa", markerColor: "darkblue"});
+    return L.marker(new L.LatLng(row[0], row[1]), {icon: icon}).bindPopup(row[2]);
+}
+"""
 
-        dataset_dict[filename] = large_df
 
-    return dataset_dict
-
-
-
-def excel_round(number, precision=0.01) -> float:
+@timed
+def build_map_html(gps, latitudes, longitudes, cluster_threshold=MAP_CLUSTER_THRESHOLD):
     """
-    Rounds a number to a specified precision using the "round half up" method, similar to Excel.
+    Draws the map of the practices in a place, as the HTML rendered by the tool.
+    Up to cluster_threshold practices are drawn as individual markers; larger places are drawn as one clustered layer, so the HTML holds
+    the coordinates once rather than a block of script for every marker.
 
     Parameters:
-    number (float/int): The number to be rounded.
-    precision (float/int): The precision to round to (e.g., 0.1, 0.01, 100, etc.).
+    gps: The practice_display values of the practices, used as the popup labels.
+    latitudes: A numpy array of the practices' latitudes.
+    longitudes: A numpy array of the practices' longitudes.
+    cluster_threshold: The largest number of practices drawn as individual markers.
 
     Returns:
-    float: The rounded number, or the original value if it's not numeric.
+    html: The HTML of the map, sized to be rendered 700 by 300 pixels
     """
-    try:
-        if isinstance(number, (int, float)):  # Ensure the number is numeric
-            if precision > 1:  # For rounding to nearest ten, hundreds, etc.
-                rounded_num = round(number / precision) * precision
-            else:  # For decimal precision
-                number = Decimal(str(number))
-                precision = Decimal(str(precision))
-                rounded_num = number.quantize(precision, rounding=ROUND_HALF_UP)
-            return float(rounded_num)
-        else:
-            return number  # Return the value unchanged if it's not numeric
-    except (ValueError, InvalidOperation):
-        return number  # Return the value unchanged if there's an error during conversion
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    # Initialises the map
+    map = folium.Map(location=[52, 0], zoom_start=10, tiles="openstreetmap")
+    if len(gps) > cluster_threshold:
+        FastMarkerCluster(
+            [[latitude, longitude, str(gp)] for gp, latitude, longitude in zip(gps, latitudes.tolist(), longitudes.tolist())],
+            callback=MAP_CLUSTER_CALLBACK,
+        ).add_to(map)
+    else:
+        # Populates the map with a marker for each practice, with a popup label matching the practice
+        for gp, latitude, longitude in zip(gps, latitudes.tolist(), longitudes.tolist()):
+            folium.Marker(
+                [latitude, longitude],
+                popup=str(gp),
+                icon=folium.Icon(color="darkblue", icon="fa-user-md", prefix="fa"),
+            ).add_to(map)
+    # bounds method https://stackoverflow.com/a/58185815
+    # Sets the bounds of the map; ensures all markers are visible with a margin added to the latitude
+    map.fit_bounds(
+        [[latitudes.min() - 0.02, longitudes.min()], [latitudes.max() + 0.02, longitudes.max()]]
+    )
+    # Wraps the map in a figure, in the same way as streamlit_folium.folium_static
+    return folium.Figure().add_child(map).render()
+
 
 # Helper function to inject CSS for sidebar width
 def set_sidebar_width(min_width=300, max_width=300):
+    import streamlit as st
+
     st.markdown(
         f"""
         <style>
@@ -311,55 +278,95 @@ def set_sidebar_width(min_width=300, max_width=300):
         unsafe_allow_html=True
     )
 
-#Fetch latest date of commit to main GitHub repo main branch and format it for display in tool
-def get_latest_commit_date(owner, repo, branch):
+# Base URL of the GitHub API, can be pointed elsewhere (e.g. a local stub server in tests)
+GITHUB_API_URL = "https://api.github.com"
+
+# Connect and read timeouts, in seconds, for calls to the GitHub API
+GITHUB_TIMEOUT = (3.05, 5)
+
+
+def fetch_latest_update(owner, repo, branch, folder_path=None, api_url=GITHUB_API_URL, timeout=GITHUB_TIMEOUT):
     """
-    Uses the requests library to pull the latest commit date for the repo from GitHub API.
+    Uses the requests library to pull the latest commit date for the repo, or for a folder in the repo, from GitHub API.
+    Unlike get_latest_commit_date and get_latest_folder_update, errors are raised rather than returned as a message.
 
     Parameters:
     owner (string): The username of the owner of the repo
     repo (string): The repo to fetch the latest commit date from
     branch (string): The branch to fetch the latest commit date from
-
-    Note: In the tool, the parameters are populated from the config file, to make future updates easier.
+    folder_path (string): Optional folder path to check for changes; the whole repo is checked if not given
+    api_url (string): Base URL of the GitHub API
+    timeout (float or tuple): Connect and read timeouts in seconds, passed to requests.get
 
     Returns:
-    formatted_date (string): The date of the last commit to the specified repo and branch in the format "DD month YYYY"
+    formatted_date (string): The date of the last commit in the format "DD month YYYY"
+
+    Raises:
+    requests.RequestException: If GitHub can't be reached or returns an error status
+    LookupError: If no commits are found
+    ValueError, KeyError: If the returned response can't be parsed
     """
+    import requests
+
     # Constructs the GitHub API URL to find commits
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits"
-    # Adds query parameters for the branch and limits it to 1 return (the most recent)
+    url = f"{api_url}/repos/{owner}/{repo}/commits"
+    # Adds query parameters for the branch (and folder path) and limits it to 1 return (the most recent)
     params = {
         "sha": branch,
         "per_page": 1
     }
-    response = requests.get(url, params=params)
-    # Checks if the API call was successful (200 = OK)
-    if response.status_code == 200:
-        # Parses the API response from JSON
-        commits = response.json()
-        # Confirms the response is not empty
-        if commits:
-            try:
-                # Extracts the commit date string
-                date_str = commits[0]["commit"]["committer"]["date"]
-                # Converts to Python datetime
-                date_obj = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
-                # Formats to DD Month YYYY
-                formatted_date = date_obj.strftime("%d %B %Y")
-                return formatted_date
-            # If the returned response doesn't meet the above parameters prints an error message
-            except Exception as e:
-                return f"Error parsing date {e}"
-        # If the API response is empty, prints an error
-        else:
-            return "No commits found."
-    # If the API call fails prints the error code
-    else:
-        return f"GitHub API error: {response.status_code}"
+    if folder_path is not None:
+        params["path"] = folder_path
+    response = requests.get(url, params=params, timeout=timeout)
+    # Raises an error if the API call wasn't successful
+    response.raise_for_status()
+    commits = response.json()
+    # Confirms the response is not empty
+    if not commits:
+        raise LookupError("No commits found.")
+    # Extracts the commit date string
+    date_str = commits[0]["commit"]["committer"]["date"]
+    # Converts to Python datetime and formats to DD Month YYYY
+    return datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ").strftime("%d %B %Y")
+
+
+#Fetch latest date of commit to main GitHub repo main branch and format it for display in tool
+def get_latest_commit_date(owner, repo, branch, api_url=GITHUB_API_URL, timeout=GITHUB_TIMEOUT):
+    """
+    Uses the requests library to pull the latest commit date for the repo from GitHub API.
+
+    Parameters:
+    owner (string): The username of the owner of the repo
+    repo (string): The repo to fetch the latest commit date from
+    branch (string): The branch to fetch the latest commit date from
+    api_url (string): Base URL of the GitHub API
+    timeout (float or tuple): Connect and read timeouts in seconds
+
+    Note: In the tool, the parameters are populated from the config file, to make future updates easier.
+    The tool itself reads the date through LastUpdatedCache, so the page never waits on GitHub.
+
+    Returns:
+    formatted_date (string): The date of the last commit to the specified repo and branch in the format "DD month YYYY", or an error message
+    """
+    import requests
+
+    try:
+        return fetch_latest_update(owner, repo, branch, api_url=api_url, timeout=timeout)
+    # If the API response is empty, returns an error
+    except LookupError as e:
+        return str(e)
+    # If the API call fails returns the error code
+    except requests.HTTPError as e:
+        return f"GitHub API error: {e.response.status_code}"
+    # If GitHub can't be reached returns the error
+    except requests.RequestException as e:
+        return f"GitHub API error: {e}"
+    # If the returned response doesn't meet the above parameters returns an error message
+    except Exception as e:
+        return f"Error parsing date {e}"
     
 #Fetch latest date of commit to main GitHub repo main branch and format it for display in tool
-def get_latest_folder_update(owner, repo, folder_path, branch):
+def get_latest_folder_update(owner, repo, folder_path, branch, api_url=GITHUB_API_URL, timeout=GITHUB_TIMEOUT):
     """
     Uses the requests library to pull the latest update date for a specific folder in the repo from GitHub API.
 
@@ -368,37 +375,126 @@ def get_latest_folder_update(owner, repo, folder_path, branch):
     repo (string): The repo to fetch the latest commit date from
     folder path (string): The folder path to check for changes
     branch (string): The branch to fetch the latest commit date from
+    api_url (string): Base URL of the GitHub API
+    timeout (float or tuple): Connect and read timeouts in seconds
 
     Note: In the tool, the parameters are populated from the config file, to make future updates easier.
+    The tool itself reads the date through LastUpdatedCache, so the page never waits on GitHub.
 
     Returns:
-    formatted_date (string): The date of the last update to the specified folder, repo, and branch in the format "DD month YYYY"
+    formatted_date (string): The date of the last update to the specified folder, repo, and branch in the format "DD month YYYY", or an error message
     """
-    # Constructs the GitHub API URL to find commits
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits"
-    # Adds query parameters for the folder path and branch and limits it to 1 return (the most recent)
-    params = {
-        "path": folder_path,
-        "sha": branch,
-        "per_page": 1
-    }
-    # Sends the request to GitHub using above details
-    response = requests.get(url, params=params)
-    # Checks if the API call was successful (200 = OK)
-    if response.status_code == 200:
+    import requests
+
+    try:
+        return fetch_latest_update(owner, repo, branch, folder_path=folder_path, api_url=api_url, timeout=timeout)
+    # If the API call fails returns the error code
+    except requests.HTTPError as e:
+        return f"GitHub API error: {e.response.status_code}"
+    # If GitHub can't be reached returns the error
+    except requests.RequestException as e:
+        return f"GitHub API error: {e}"
+    # If the returned response doesn't meet the above parameters returns an error message
+    except Exception as e:
+        return f"Error parsing date: {e}"
+
+
+def get_local_update_date(path="."):
+    """
+    Finds the date a file or folder was last updated without calling GitHub, used when GitHub can't be reached.
+    Uses the date of the last git commit touching the path if the tool is running from a git checkout,
+    otherwise the most recent modification time of the files under the path.
+
+    Parameters:
+    path (string): The file or folder to check, e.g. "data"
+
+    Returns:
+    formatted_date (string): The date of the last update in the format "DD month YYYY"
+    """
+    try:
+        result = subprocess.run(
+            ["git", "log", "-1", "--format=%ct", "--", path],
+            capture_output=True, text=True, timeout=2, check=True,
+        )
+        timestamp = float(result.stdout.strip())
+    except (OSError, ValueError, subprocess.SubprocessError):
+        # Not a git checkout (or git isn't installed), so falls back to file modification times, skipping the data cache
+        timestamps = [os.path.getmtime(path)]
+        for folder, folders, files in os.walk(path):
+            folders[:] = [name for name in folders if name not in (DATA_CACHE_FOLDER, ".git")]
+            timestamps += [os.path.getmtime(os.path.join(folder, name)) for name in files]
+        timestamp = max(timestamps)
+    return datetime.fromtimestamp(timestamp).strftime("%d %B %Y")
+
+
+class LastUpdatedCache:
+    """
+    Process-wide cache of "last updated" dates with a time-to-live, shared by every session of the tool.
+    Reading a date never waits on the network or on git: if the date is missing or older than ttl seconds, a background thread
+    fetches a fresh one and the last known date (or a default, if there isn't one yet) is returned straight away.
+    The background thread stores the local fallback date first, so it is shown while GitHub is asked.
+    Failed fetches are retried after the ttl, with the fallback date shown in the meantime.
+
+    Parameters:
+    ttl: How long, in seconds, a fetched date is kept before it is refreshed.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, fallback, default=None):
+        """
+        Returns the cached date for key, starting a background refresh if it is missing or expired.
+
+        Parameters:
+        key: A name for the date, e.g. "commit".
+        fetch: A function taking no arguments that returns the date, raising an error if it can't.
+        fallback: A function taking no arguments that returns a date without using the network, e.g. from git.  Only called from the background thread.
+        default: Returned until the background thread has found a date.
+
+        Returns:
+        The cached date, or default if none has been found yet
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            expired = entry is None or time.monotonic() - entry["time"] > self.ttl
+            if expired and key not in self._refreshing:
+                self._refreshing.add(key)
+                threading.Thread(target=self.refresh, args=(key, fetch, fallback), daemon=True).start()
+        if entry is None:
+            return default
+        return entry["value"]
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = {"value": value, "time": time.monotonic()}
+
+    def refresh(self, key, fetch, fallback):
+        """
+        Fetches the date for key and stores it, storing the fallback date instead if the fetch fails.
+        The refresh is always marked as finished, even if the fallback fails too (when None is returned), so the date is tried again on a later read.
+        """
         try:
-            # Parses the response from json
-            commit_data = response.json()[0]
-            # Extracts the commit date string
-            date_str = commit_data["commit"]["committer"]["date"]
-            # Converts to Python datetime
-            date_obj = datetime.strptime(date_str, "%Y-%m-%dT%H:%M:%SZ")
-            # Formats to DD Month YYYY
-            formatted_date = date_obj.strftime("%d %B %Y")
-            return formatted_date
-        # If the returned response doesn't meet the above parameters prints an error message
+            local = None
+            with self._lock:
+                known = key in self._entries
+            if not known:
+                local = fallback()
+                self._store(key, local)
+            try:
+                value = fetch()
+            except Exception as e:
+                print(f"Could not fetch {key} date, using local date instead: {e}")
+                value = fallback() if local is None else local
+            self._store(key, value)
+            return value
         except Exception as e:
-            return f"Error parsing date: {e}"
-    # If the API call fails prints the error code
-    else:
-        return f"GitHub API error: {response.status_code}"
\ No newline at end of file
+            # Neither GitHub nor the fallback gave a date, so nothing is stored and the next read tries again
+            print(f"Could not find {key} date: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)